@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Concurrent, rate limited and cached calls to speech recognition and machine translation APIs
+
+Running this file directly measures the throughput of the dispatcher offline,
+with a stub provider standing in for the real APIs.
+"""
+
+import hashlib, json, os, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Defining an error for failures that should not be cached, such as a request that did not reach the API, with the response to use instead
+class TransientError(Exception):
+    def __init__(self, fallback):
+        super(TransientError, self).__init__(fallback)
+        self.fallback = fallback
+
+# Defining a function to turn an input into bytes identifying it, from the raw samples of recorded audio or the text itself
+def fingerprint(value):
+    if isinstance(value, str):
+        return(value.encode('utf-8'))
+    return('{}-{}-'.format(value.sample_rate, value.sample_width).encode() + value.get_raw_data())
+
+# Defining a token bucket, which lets capacity calls through at once and then rate calls per second
+class TokenBucket():
+    def __init__(self, rate, capacity = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Taking a token, or reserving the next one and sleeping until it is due, without holding the lock while sleeping
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            wait = max(0, (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        time.sleep(wait)
+
+# Defining an on-disk cache of responses, with one file per (provider, input) pair named after their hash
+class ResponseCache():
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    def key(self, provider, value):
+        return(hashlib.sha256(provider.encode('utf-8') + b'\0' + fingerprint(value)).hexdigest())
+
+    def get(self, key):
+        cached_file = os.path.join(self.path, key + '.json')
+        if not os.path.exists(cached_file):
+            return(False, None)
+        with open(cached_file, mode = 'rt', encoding = 'utf-8') as file:
+            return(True, json.load(file)['response'])
+
+    # Writing a temporary file first, so that concurrent or interrupted writes never leave a partial entry behind
+    def put(self, key, response):
+        cached_file = os.path.join(self.path, key + '.json')
+        temporary_file = '{}.{}.{}.tmp'.format(cached_file, os.getpid(), threading.get_ident())
+        with open(temporary_file, mode = 'wt', encoding = 'utf-8') as file:
+            json.dump({'response': response}, file)
+        os.replace(temporary_file, cached_file)
+
+# Defining a dispatcher that runs calls in a thread pool, each provider behind its own token bucket and all of them behind the cache
+class Dispatcher():
+    def __init__(self, cache_path = None, max_workers = 8):
+        self.providers = {}
+        self.cache = None if cache_path is None else ResponseCache(cache_path)
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def register(self, name, provider, rate, capacity = 1):
+        self.providers[name] = (provider, TokenBucket(rate, capacity))
+
+    def call(self, name, value):
+        provider, bucket = self.providers[name]
+        if self.cache is not None:
+            key = self.cache.key(name, value)
+            found, response = self.cache.get(key)
+            if found:
+                return(response)
+        bucket.acquire()
+        try:
+            response = provider(value)
+        except TransientError as error:
+            return(error.fallback)
+        if self.cache is not None:
+            self.cache.put(key, response)
+        return(response)
+
+    def submit(self, name, value):
+        return(self.executor.submit(self.call, name, value))
+
+    def map(self, name, values):
+        futures = [self.submit(name, value) for value in values]
+        return([future.result() for future in futures])
+
+# Defining a provider to detect speech by Google, with one recogniser reused for every call
+class GoogleRecogniser():
+    def __init__(self):
+        import speech_recognition
+        self.speech_recognition = speech_recognition
+        self.recogniser = speech_recognition.Recognizer()
+
+    def __call__(self, recorded_audio):
+        try:
+            return(self.recogniser.recognize_google(recorded_audio))
+        except self.speech_recognition.UnknownValueError:
+            return("")
+        except self.speech_recognition.RequestError:
+            raise TransientError("")
+
+# Defining a provider to detect speech by Wit, with one recogniser reused for every call
+class WitRecogniser():
+    def __init__(self, key):
+        import speech_recognition
+        self.speech_recognition = speech_recognition
+        self.recogniser = speech_recognition.Recognizer()
+        self.key = key
+
+    def __call__(self, recorded_audio):
+        try:
+            return(self.recogniser.recognize_wit(recorded_audio, self.key))
+        except self.speech_recognition.UnknownValueError:
+            return("")
+        except self.speech_recognition.RequestError:
+            raise TransientError("")
+
+# Defining a provider to translate by Google, with one translator reused for every call
+class GoogleTranslator():
+    def __init__(self, source = 'en', destination = 'fr'):
+        from googletrans import Translator
+        self.translator = Translator()
+        self.source = source
+        self.destination = destination
+
+    def __call__(self, text):
+        return(self.translator.translate(text, src = self.source, dest = self.destination).text)
+
+# Defining a provider to translate by Yandex, with one client reused for every call
+class YandexTranslator():
+    def __init__(self, key, direction = 'en-fr'):
+        from yandex_translate import YandexTranslate
+        self.translator = YandexTranslate(key)
+        self.direction = direction
+
+    def __call__(self, text):
+        return(self.translator.translate(text, self.direction)['text'][0])
+
+# Defining a provider that answers locally after a fixed latency, standing in for the real APIs in offline tests
+class StubProvider():
+    def __init__(self, latency = 0.05):
+        self.latency = latency
+
+    def __call__(self, value):
+        time.sleep(self.latency)
+        return(hashlib.sha256(fingerprint(value)).hexdigest()[:16])
+
+# Defining a function to compare sequential calls, concurrent calls and a rerun served by the cache
+def benchmark(n_calls = 100, latency = 0.05, rate = 50, capacity = 10, max_workers = 16):
+    texts = ['sentence number {}'.format(i) for i in range(n_calls)]
+    stub = StubProvider(latency)
+    tic = time.perf_counter()
+    for text in texts:
+        stub(text)
+    sequential = time.perf_counter() - tic
+    with tempfile.TemporaryDirectory() as cache_path:
+        dispatcher = Dispatcher(cache_path, max_workers)
+        dispatcher.register('stub', stub, rate, capacity)
+        tic = time.perf_counter()
+        dispatcher.map('stub', texts)
+        concurrent = time.perf_counter() - tic
+        tic = time.perf_counter()
+        dispatcher.map('stub', texts)
+        cached = time.perf_counter() - tic
+        dispatcher.executor.shutdown()
+    print("Calls: %d \t Latency: %.0f ms \t Rate limit: %d/s" % (n_calls, 1000 * latency, rate))
+    print("Sequential: %.1f calls/s \t Concurrent: %.1f calls/s \t Cached rerun: %.1f calls/s" % (n_calls / sequential, n_calls / concurrent, n_calls / cached))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Character and word edit distances for whole batches of sentence pairs
+
+Running this file directly checks that the batch functions agree with the
+original levenshtein and wer of the evaluation notebook on a synthetic
+regression corpus, and compares their speed across sentence lengths.
+"""
+
+import numpy as np, random, string, time
+from concurrent.futures import ProcessPoolExecutor
+
+# Defining a function to encode strings as arrays of code points
+def encode_characters(texts):
+    return([np.frombuffer(text.encode('utf-32-le'), dtype = np.uint32).astype(np.int64) for text in texts])
+
+# Defining a function to encode strings as arrays of word indices shared by the whole batch
+def encode_words(texts):
+    vocabulary = {}
+    return([np.array([vocabulary.setdefault(word, len(vocabulary)) for word in text.split()], dtype = np.int64) for text in texts])
+
+# Defining a function to pad sequences of indices into a matrix, with a padding value that never matches a real index
+def pad(sequences, padding):
+    lengths = np.array([len(sequence) for sequence in sequences])
+    matrix = np.full((len(sequences), max(lengths.max(), 1)), padding, dtype = np.int64)
+    matrix[np.arange(matrix.shape[1]) < lengths[:, np.newaxis]] = np.concatenate(sequences)
+    return(matrix, lengths)
+
+# Defining a function to compute edit distances for a chunk of pairs at once, keeping a single row of the table per pair
+# Rows run over the longer sequence of each pair and columns over the shorter one, so memory is O(min(n, m)) per pair
+# The original levenshtein let an insertion move by only one column per row, which exact = False reproduces
+def distances(longer, shorter, exact = True):
+    longer, longer_lengths = pad(longer, -1)
+    shorter, shorter_lengths = pad(shorter, -2)
+    columns = np.arange(shorter.shape[1] + 1)
+    previous_row = np.tile(columns, (len(longer), 1))
+    for i in range(longer.shape[1]):
+        cost = (shorter != longer[:, i:(i + 1)])
+        current_row = np.empty_like(previous_row)
+        current_row[:, 0] = previous_row[:, 0] + 1
+        current_row[:, 1:] = np.minimum(previous_row[:, 1:] + 1, previous_row[:, :-1] + cost)
+        if exact:
+            current_row = columns + np.minimum.accumulate(current_row - columns, axis = 1)
+        else:
+            current_row[:, 1:] = np.minimum(current_row[:, 1:], current_row[:, :-1] + 1)
+        # pairs whose longer sequence has ended keep their last row
+        previous_row = np.where((i < longer_lengths)[:, np.newaxis], current_row, previous_row)
+    return(previous_row[np.arange(len(longer)), shorter_lengths])
+
+# Defining a function to compute edit distances of every pair, ordering the sequences of each pair by length
+# Pairs are sorted by length and split in chunks, so that little padding is computed, and chunks may run in a process pool
+def batch_distances(sources, targets, exact = True, chunk_size = 256, n_jobs = None):
+    swap = np.array([len(source) < len(target) for source, target in zip(sources, targets)], dtype = bool)
+    longer = [target if swapped else source for source, target, swapped in zip(sources, targets, swap)]
+    shorter = [source if swapped else target for source, target, swapped in zip(sources, targets, swap)]
+    order = np.argsort([len(sequence) for sequence in longer], kind = 'stable')
+    chunks = [order[start:(start + chunk_size)] for start in range(0, len(order), chunk_size)]
+    arguments = ([[longer[k] for k in chunk] for chunk in chunks], [[shorter[k] for k in chunk] for chunk in chunks], [exact] * len(chunks))
+    if n_jobs is None:
+        results = map(distances, *arguments)
+    else:
+        executor = ProcessPoolExecutor(n_jobs)
+        results = executor.map(distances, *arguments)
+    result = np.zeros(len(sources), dtype = np.int64)
+    for chunk, chunk_distances in zip(chunks, results):
+        result[chunk] = chunk_distances
+    if n_jobs is not None:
+        executor.shutdown()
+    return(result, np.array([len(sequence) for sequence in longer], dtype = np.int64))
+
+# Defining a function to compute the Levenshtein distance of every pair of strings, divided by the length of the longer one
+def levenshtein_batch(sources, targets, exact = False, chunk_size = 256, n_jobs = None):
+    result, lengths = batch_distances(encode_characters(sources), encode_characters(targets), exact, chunk_size, n_jobs)
+    return(np.where(lengths == 0, 0.0, result / np.maximum(lengths, 1)))
+
+# Defining a function to calculate the word error rate of every recognised text against its actual text
+def wer_batch(recognised, actual, chunk_size = 256, n_jobs = None):
+    encoded = encode_words(list(recognised) + list(actual))
+    result, _ = batch_distances(encoded[:len(recognised)], encoded[len(recognised):], True, chunk_size, n_jobs)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return(result / np.array([len(sequence) for sequence in encoded[len(recognised):]], dtype = np.float64))
+
+# Defining a function to compute Levenshtein Distance
+def levenshtein(source, target):
+    return(levenshtein_batch([source], [target])[0])
+
+# Defining a function to calculate word error rate
+def wer(recognised, actual):
+    return(wer_batch([recognised], [actual])[0])
+
+# Defining the original function to compute Levenshtein Distance, as the reference of the regression check
+def original_levenshtein(source, target):
+    if len(source) < len(target):
+        return(original_levenshtein(target, source))
+    if len(source) == 0:
+        return(0)
+    else:
+        if len(target) == 0:
+            return(1)
+        source = np.array(tuple(source))
+        target = np.array(tuple(target))
+        previous_row = np.arange(target.size + 1)
+        for s in source:
+            current_row = previous_row + 1
+            current_row[1:] = np.minimum(current_row[1:], np.add(previous_row[:-1], target != s))
+            current_row[1:] = np.minimum(current_row[1:], current_row[0:-1] + 1)
+            previous_row = current_row
+        return(previous_row[-1] / len(source))
+
+# Defining the original function to calculate word error rate, as the reference of the regression check
+def original_wer(recognised, actual):
+    recognised = recognised.split()
+    actual = actual.split()
+    d = np.zeros(((len(recognised) + 1), (len(actual) + 1)), dtype = int)
+    for i in range(len(recognised) + 1):
+        for j in range(len(actual) + 1):
+            if i == 0:
+                d[0][j] = j
+            elif j == 0:
+                d[i][0] = i
+    for i in range(1, len(recognised) + 1):
+        for j in range(1, len(actual) + 1):
+            if recognised[i - 1] == actual[j - 1]:
+                d[i][j] = d[i - 1][j - 1]
+            else:
+                substitution = d[i - 1][j - 1] + 1
+                insertion = d[i][j - 1] + 1
+                deletion = d[i - 1][j] + 1
+                d[i][j] = min(substitution, insertion, deletion)
+    return(d[len(recognised)][len(actual)] / len(actual))
+
+# Defining a function to create a reference sentence and a noisy recognition of it
+def sentence_pair(n_words, words):
+    reference = [random.choice(words) for _ in range(n_words)]
+    hypothesis = [word for word in reference if random.random() > 0.1]
+    for _ in range(random.randint(0, max(1, n_words // 5))):
+        hypothesis.insert(random.randint(0, len(hypothesis)), random.choice(words))
+    return(' '.join(hypothesis), ' '.join(reference))
+
+# Defining a function to check the batch functions against the original ones and to time both
+def benchmark(n_pairs = 500, lengths = (5, 20, 50)):
+    random.seed(0)
+    words = [''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(1, 6))) for _ in range(200)]
+    for n_words in lengths:
+        hypotheses, references = zip(*[sentence_pair(n_words, words) for _ in range(n_pairs)])
+        tic = time.perf_counter()
+        expected_levenshtein = np.array([original_levenshtein(hypothesis, reference) for hypothesis, reference in zip(hypotheses, references)], dtype = np.float64)
+        expected_wer = np.array([original_wer(hypothesis, reference) for hypothesis, reference in zip(hypotheses, references)])
+        original = time.perf_counter() - tic
+        tic = time.perf_counter()
+        batch_levenshtein = levenshtein_batch(hypotheses, references)
+        batch_wer = wer_batch(hypotheses, references)
+        batch = time.perf_counter() - tic
+        identical = np.array_equal(expected_levenshtein, batch_levenshtein) and np.array_equal(expected_wer, batch_wer)
+        print("Words: %d \t Pairs: %d \t Identical: %s \t Original: %.3f s \t Batch: %.3f s \t Speedup: %.1fx" % (n_words, n_pairs, identical, original, batch, original / batch))
+
+if __name__ == '__main__':
+    benchmark()
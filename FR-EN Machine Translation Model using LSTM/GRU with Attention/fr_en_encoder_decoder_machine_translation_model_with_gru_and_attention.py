@@ -7,7 +7,7 @@ Original file is located at
     https://colab.research.google.com/drive/1Db2Hexcp6dFxLbRTQoTNCHZ6Z04l4SJc
 """
 
-import matplotlib.pyplot as plt, numpy as np, os, re, time, tensorflow as tf, unicodedata
+import itertools, matplotlib.pyplot as plt, numpy as np, os, time, tensorflow as tf
 from google.colab import files
 tf.enable_eager_execution()
 
@@ -19,103 +19,106 @@ for counter in files_in_directory:
 # uploading file
 uploaded = files.upload()
 
-# removing the accents
-def unicode_to_ascii(string):
-    return ''.join(character for character in unicodedata.normalize('NFD', string) if unicodedata.category(character) != 'Mn')
+# importing the shared modules uploaded alongside the dataset
+from text_normalizer import normalize_sentence
+from corpus_loader import preprocess_pairs, read_lines, stream_dataset
+from bucketing import bucket_batches, bucket_length, padding_report, sequence_lengths, trim_batch
+from vocabulary import Vocabulary
+from inference_bundle import export_attention_translator, export_checked, load_translator
+from instrumentation import create_instrument
+from training_state import atomic_savez, cached_arrays, file_key, load_arrays, random_state, set_random_state
 
-# cleaning a sentence
+# cleaning a sentence and adding a start and an end token to it
 def preprocess_sentence(line):
-    # converting from unicode to ascii
-    line = unicode_to_ascii(line.lower().strip())
-
-    # creating a space between a word and the punctuation following it, and then collapsing multiple spaces
-    line = re.sub(r"([!',-.0-9?])", r" \1 ", line)
-    line = re.sub(r'[" "]+', " ", line)
-
-    # replacing everything with space except a-z, A-Z, "!", "'", ",", "-", ".", 0-9, "?"
-    line = re.sub(r"[^a-zA-Z!',-.0-9?]+", " ", line).strip()
-
-    # adding a start and an end token to the sentence
-    line = '<start> ' + line + ' <end>'
-
-    return line
+    return normalize_sentence(line, add_tokens = True)
 
 # creating line pairs in the format: [target, source]
-def create_dataset(filepath, size):
-    # open the file as read only, read all text and split in lines
-    pairs = open(filepath, mode = 'rt', encoding='UTF-8').read().strip().split('\n')
-
-    # reducing dataset, splitting into target - source pairs and cleaning
-    line_pairs = [[preprocess_sentence(line) for line in pair.split('\t')] for pair in pairs[:size]]
-
-    return line_pairs
-
-# creating a class for word -> index mapping
-class LanguageIndex():
-    def __init__(self, language):
-        self.language = language
-        self.word_to_index = {}
-        self.index_to_word = {}
-        self.vocabulary = set()
-        self.create_index()
-
-    def create_index(self):
-        for phrase in self.language:
-            self.vocabulary.update(phrase.split(' '))
-
-        self.vocabulary = sorted(self.vocabulary)
-
-        self.word_to_index['<pad>'] = 0
-        for index, word in enumerate(self.vocabulary):
-            self.word_to_index[word] = index + 1
-
-        for word, index in self.word_to_index.items():
-            self.index_to_word[index] = word
-
-# finding maximum sentence length
-def maximum_length(lines):
-    return max(len(line.split()) for line in lines)
-
-def maximum_length(tensor):
-    return max(len(element) for element in tensor)
+def create_dataset(filepath, size, n_processes = None, chunk_size = 1000):
+    return list(stream_dataset(filepath, size, True, n_processes, chunk_size))
 
 # loading dataset in required format
 def load_dataset(filepath, size):
     # creating cleaned input, output pairs
     pairs = create_dataset(filepath, size)
 
-    # index language using the class defined above    
-    source_language = LanguageIndex(source for target, source in pairs)
-    target_language = LanguageIndex(target for target, source in pairs)
+    # indexing each language with the shared array backed vocabulary
+    source_language = Vocabulary.fit(source for target, source in pairs)
+    target_language = Vocabulary.fit(target for target, source in pairs)
 
-    # vectorising the input and target languages
-    input_tensor = [[source_language.word_to_index[sentence] for sentence in source.split(' ')] for target, source in pairs]
-    target_tensor = [[target_language.word_to_index[sentence] for sentence in target.split(' ')] for target, source in pairs]
+    # vectorising the input and target languages straight into matrices padded to the longest sentence in the dataset
+    input_tensor = source_language.encode_batch([source for target, source in pairs])
+    target_tensor = target_language.encode_batch([target for target, source in pairs])
+    maximum_length_source, maximum_length_target = input_tensor.shape[1], target_tensor.shape[1]
 
-    # calculating maximum length of input and output tensor, which we will set to the longest sentence in the dataset
-    maximum_length_source, maximum_length_target = maximum_length(input_tensor), maximum_length(target_tensor)
-    
-    # padding the input and output tensor to the maximum length
-    input_tensor = tf.keras.preprocessing.sequence.pad_sequences(input_tensor, maxlen = maximum_length_source, padding = 'post')
-    target_tensor = tf.keras.preprocessing.sequence.pad_sequences(target_tensor, maxlen = maximum_length_target, padding = 'post')
-    
     return pairs, input_tensor, target_tensor, source_language, target_language, maximum_length_source, maximum_length_target
 
+# keeping the tokenized dataset and the checkpoints in a folder, which the removal of the files above leaves in place
+# pointing it to a mounted Google Drive folder keeps them across runtime resets as well
+CHECKPOINT_DIRECTORY = 'training_checkpoints'
+os.makedirs(CHECKPOINT_DIRECTORY, exist_ok = True)
+
+# caching the tokenized dataset, so that a restart loads its tensors and vocabularies instead of running load_dataset again
+def load_cached_dataset(filepath, size):
+    def create():
+        pairs, input_tensor, target_tensor, source_language, target_language, _, _ = load_dataset(filepath, size)
+        return {'pairs': np.array(pairs, dtype = str), 'input_tensor': input_tensor, 'target_tensor': target_tensor, 'source_words': source_language.words, 'target_words': target_language.words}
+
+    arrays, cached = cached_arrays(os.path.join(CHECKPOINT_DIRECTORY, 'tokenized_dataset.npz'), file_key(filepath, size), create)
+    input_tensor, target_tensor = arrays['input_tensor'], arrays['target_tensor']
+    return arrays['pairs'].tolist(), input_tensor, target_tensor, Vocabulary(arrays['source_words']), Vocabulary(arrays['target_words']), input_tensor.shape[1], target_tensor.shape[1], cached
+
 # loading reduced dataset
+tic = time.time()
 reduced_size = 35000
-data, dataX, dataY, vocabX, vocabY, sizeX, sizeY = load_dataset('fra.txt', reduced_size)
+data, dataX, dataY, vocabX, vocabY, sizeX, sizeY, cached = load_cached_dataset('fra.txt', reduced_size)
+dataset_seconds = time.time() - tic
+print('Dataset {} in {:.2f} seconds'.format('loaded from the cache' if cached else 'tokenized', dataset_seconds))
 
 BATCH_SIZE = 64
 embedding_dimension = 256
 units = 1024
-vocabulary_source_size = len(vocabX.word_to_index)
-vocabulary_target_size = len(vocabY.word_to_index)
-
-dataset = tf.data.Dataset.from_tensor_slices((dataX, dataY)).shuffle(len(dataX))
-dataset = dataset.apply(tf.contrib.data.batch_and_drop_remainder(BATCH_SIZE))
-
+vocabulary_source_size = len(vocabX)
+vocabulary_target_size = len(vocabY)
+
+# grouping sentences of similar lengths in batches, so that each batch is padded only to its own longest sentence
+BUCKETING = True
+# rounding the padded length of every batch up to a multiple of LENGTH_STEP, so that the compiled step is traced for a few batch shapes only
+LENGTH_STEP = 4
+# preparing the next PREFETCH batches on the host while the current one trains
+PREFETCH = 2
+lengthX, lengthY = sequence_lengths(dataX), sequence_lengths(dataY)
+
+# drawing the batches of an epoch as rows of sentence indices, so that the order of an interrupted epoch can be saved and resumed
+def epoch_order():
+    if BUCKETING:
+        return np.stack(bucket_batches((lengthY, lengthX), BATCH_SIZE, drop_remainder = True))
+    order = np.random.permutation(len(dataX))
+    return order[:len(order) - len(order) % BATCH_SIZE].reshape(-1, BATCH_SIZE)
+
+# serving the batches of an epoch from first_batch onwards
+def epoch_dataset(order, first_batch = 0, prefetch = PREFETCH, bucketing = BUCKETING):
+    def batches():
+        for indices in order[first_batch:]:
+            if bucketing:
+                yield trim_batch(dataX, lengthX, indices, LENGTH_STEP), trim_batch(dataY, lengthY, indices, LENGTH_STEP)
+            else:
+                yield dataX[indices], dataY[indices]
+
+    dataset = tf.data.Dataset.from_generator(batches, (tf.int32, tf.int32), (tf.TensorShape([BATCH_SIZE, None]), tf.TensorShape([BATCH_SIZE, None])))
+    return dataset.prefetch(prefetch) if prefetch else dataset
+
+dataset = epoch_dataset(epoch_order())
+if BUCKETING:
+    padding_report((lengthX, lengthY), bucket_batches((lengthY, lengthX), BATCH_SIZE, drop_remainder = True), LENGTH_STEP)
+
+# using the cuDNN kernel on a GPU and otherwise a GRU computing the same function, so that the model also runs on CPU only machines
+# the weights are not interchangeable: the bias of CuDNNGRU has shape (6 * units, ) and the one of GRU with reset_after (2, 3 * units), so a checkpoint
+# only restores into the kind of GRU that saved it, while inference_bundle.py runs the exported weights of either kind
+CUDNN = tf.test.is_gpu_available(cuda_only = True)
 def gru(units):
-    return tf.keras.layers.CuDNNGRU(units, return_sequences=True, return_state=True, recurrent_initializer='glorot_uniform')
+    if CUDNN:
+        return tf.keras.layers.CuDNNGRU(units, return_sequences=True, return_state=True, recurrent_initializer='glorot_uniform')
+    return tf.keras.layers.GRU(units, return_sequences=True, return_state=True, recurrent_activation='sigmoid', reset_after=True, recurrent_initializer='glorot_uniform')
 
 class Encoder(tf.keras.Model):
     def __init__(self, vocabulary_size, embedding_dimension, encoder_units, batch_size):
@@ -146,9 +149,16 @@ class Decoder(tf.keras.Model):
         self.W1 = tf.keras.layers.Dense(self.decoder_units)
         self.W2 = tf.keras.layers.Dense(self.decoder_units)
         self.V = tf.keras.layers.Dense(1)
-        
-    def call(self, x, hidden, encoder_output):
+
+    # projecting the encoder output for attention, which only has to be done once per source batch
+    # encoder_keys shape == (batch_size, max_length, hidden_size)
+    def attention_keys(self, encoder_output):
+        return self.W1(encoder_output)
+
+    def call(self, x, hidden, encoder_output, encoder_keys = None):
         # encoder_output shape == (batch_size, max_length, hidden_size)
+        if encoder_keys is None:
+            encoder_keys = self.attention_keys(encoder_output)
 
         # hidden shape == (batch_size, hidden size)
         # hidden_with_time_axis shape == (batch_size, 1, hidden size)
@@ -156,7 +166,7 @@ class Decoder(tf.keras.Model):
         hidden_with_time_axis = tf.expand_dims(hidden, 1)
 
         # score shape == (batch_size, max_length, hidden_size)
-        score = tf.nn.tanh(self.W1(encoder_output) + self.W2(hidden_with_time_axis))
+        score = tf.nn.tanh(encoder_keys + self.W2(hidden_with_time_axis))
 
         # attention_weights shape == (batch_size, max_length, 1)
         # we get 1 at the last axis because we are applying score to self.V
@@ -182,6 +192,10 @@ class Decoder(tf.keras.Model):
         x = self.fc(output)
 
         return x, state, attention_weights
+
+    # decoding a single step from the previous ids, of shape (batch_size, ), reusing the encoder keys of the source batch
+    def step(self, ids, hidden, encoder_output, encoder_keys):
+        return self(tf.expand_dims(ids, 1), hidden, encoder_output, encoder_keys = encoder_keys)
         
     def initialize_hidden_state(self):
         return tf.zeros((self.batch_size, self.decoder_units))
@@ -190,52 +204,185 @@ encoder = Encoder(vocabulary_source_size, embedding_dimension, units, BATCH_SIZE
 decoder = Decoder(vocabulary_target_size, embedding_dimension, units, BATCH_SIZE)
 
 optimizer = tf.train.AdamOptimizer()
+checkpoint = tf.train.Checkpoint(encoder = encoder, decoder = decoder, optimizer = optimizer, global_step = tf.train.get_or_create_global_step())
 
+# masking the padded positions on the device, so that the loss can also be traced into a graph
 def loss_function(real, pred):
-    mask = 1 - np.equal(real, 0)
-    loss_ = tf.nn.sparse_softmax_cross_entropy_with_logits(labels = real, logits = pred) * mask
-    return tf.reduce_mean(loss_)
+    loss_ = tf.nn.sparse_softmax_cross_entropy_with_logits(labels = real, logits = pred)
+    mask = tf.cast(tf.not_equal(real, 0), loss_.dtype)
+    return tf.reduce_mean(loss_ * mask)
+
+# running the encoder and the teacher forced decoder over a batch, returning the summed loss and its gradients
+def train_step(X, Y, hidden):
+    loss = 0
+
+    with tf.GradientTape() as tape:
+        encoder_output, encoder_hidden = encoder(X, hidden)
+        encoder_keys = decoder.attention_keys(encoder_output)
+        decoder_hidden = encoder_hidden
+        decoder_input = start_tokens
+
+        # using teacher forcing
+        for t in range(1, Y.shape[1]):
+            # passing encoder_output to the decoder
+            predictions, decoder_hidden, _ = decoder(decoder_input, decoder_hidden, encoder_output, encoder_keys = encoder_keys)
+            loss += loss_function(Y[:, t], predictions)
+
+            # feeding the target as the next input
+            decoder_input = tf.expand_dims(Y[:, t], 1)
+
+    variables = encoder.variables + decoder.variables
+    gradients = tape.gradient(loss, variables)
+
+    return loss, gradients
+
+# tracing the whole step into one graph function, traced again only for batch shapes not seen before
+COMPILED = True
+# timing eager against compiled steps, reading batches with against without prefetching, and length bucketed against corpus wide padding, before a fresh start, which costs about three hundred extra steps
+COMPARE = False
+compiled_train_step = tf.contrib.eager.defun(train_step)
+start_tokens = tf.fill([BATCH_SIZE, 1], vocabY.index('<start>'))
+
+# timing eager and compiled steps on the same batches without applying their gradients, and checking that their losses match
+def compare_training_steps(n_batches = 10):
+    hidden = encoder.initialize_hidden_state()
+    batches = list(itertools.islice(dataset, n_batches))
+    losses, timings = {}, {}
 
-EPOCHS = 20
+    for name, step in (('eager', train_step), ('compiled', compiled_train_step)):
+        # the first pass creates the variables and traces every batch shape, so only the second pass is timed
+        for X, Y in batches:
+            step(X, Y, hidden)
 
-past_loss = 0
-counter = 0
+        tic = time.time()
+        losses[name] = np.array([step(X, Y, hidden)[0].numpy() for X, Y in batches])
+        timings[name] = (time.time() - tic) / len(batches)
 
-for epoch in range(EPOCHS):
-    tic = time.time()
+    print('Eager {:.3f} seconds/batch Compiled {:.3f} seconds/batch Maximum loss difference {:.2e}'.format(timings['eager'], timings['compiled'], np.max(np.abs(losses['eager'] - losses['compiled']))))
 
+# timing training steps on the same batches read with and without prefetching, without applying their gradients
+def compare_prefetching(n_batches = 20):
     hidden = encoder.initialize_hidden_state()
-    total_loss = 0
-
-    for (batch, (X, Y)) in enumerate(dataset):
-        loss = 0
+    order = epoch_order()[:n_batches]
+    step = compiled_train_step if COMPILED else train_step
+
+    # the first pass traces every batch shape, so only the second passes are timed
+    for X, Y in epoch_dataset(order, prefetch = 0):
+        step(X, Y, hidden)
+
+    for prefetch in (0, PREFETCH):
+        tic = time.time()
+        for X, Y in epoch_dataset(order, prefetch = prefetch):
+            loss, _ = step(X, Y, hidden)
+        loss.numpy()
+        print('Prefetch {} batches {:.2f} steps/sec'.format(prefetch, len(order) / (time.time() - tic)))
+
+# timing training steps on the same sentences in length bucketed batches and in batches padded to the longest sentence of the corpus, without applying their gradients
+# the rate counts the real target tokens of each batch, as the training loop does, and waits for every step so that both passes time their own batches
+def compare_bucketing(n_batches = 50):
+    hidden = encoder.initialize_hidden_state()
+    step = compiled_train_step if COMPILED else train_step
+    sample = np.random.permutation(len(dataX))[:n_batches * BATCH_SIZE]
+    orders = {False: sample.reshape(-1, BATCH_SIZE), True: sample[np.stack(bucket_batches((lengthY[sample], lengthX[sample]), BATCH_SIZE))]}
+
+    for bucketing, order in orders.items():
+        # the first pass traces every batch shape, so only the second pass is timed
+        for X, Y in epoch_dataset(order, bucketing = bucketing):
+            step(X, Y, hidden)
+
+        instrument = create_instrument('bucketing')
+        for X, Y in instrument.wrap(epoch_dataset(order, bucketing = bucketing)):
+            step(X, Y, hidden)[0].numpy()
+            instrument.batch_end(int(X.shape[0]), np.count_nonzero(Y), int(Y.shape[1]) - 1)
+        totals = instrument.totals
+        print('Bucketing {} {:.0f} tokens/sec {:.0f} decoder steps/batch'.format(bucketing, totals['tokens'] / totals['batch_seconds'], totals['decoder_steps'] / totals['batches']))
 
-        with tf.GradientTape() as tape:
-            encoder_output, encoder_hidden = encoder(X, hidden)
-            decoder_hidden = encoder_hidden
-            decoder_input = tf.expand_dims([vocabY.word_to_index['<start>']] * BATCH_SIZE, 1)
+EPOCHS = 20
+# saving a checkpoint every CHECKPOINT_EVERY batches and at the end of every epoch
+CHECKPOINT_EVERY = 250
+STATE_PATH = os.path.join(CHECKPOINT_DIRECTORY, 'training_state.npz')
+
+# saving the weights and the optimizer, then the position in the data, the early stopping counters and the random state along with the path of the saved weights
+# the training state is replaced only once both are on disk, so that a crash while saving resumes from the previous checkpoint
+def save_training_state(epoch, first_batch, order, total_loss, past_loss, counter, stopped = False):
+    path = checkpoint.save(os.path.join(CHECKPOINT_DIRECTORY, 'ckpt'))
+    atomic_savez(STATE_PATH, checkpoint = np.array(path), epoch = np.array(epoch), batch = np.array(first_batch), order = order, total_loss = np.array(float(total_loss)),
+                 past_loss = np.array(float(past_loss)), counter = np.array(counter), stopped = np.array(stopped), cudnn = np.array(CUDNN), **random_state())
+
+    # removing the checkpoints the training state no longer points to
+    for file in os.listdir(CHECKPOINT_DIRECTORY):
+        if file.startswith('ckpt-') and file.split('.')[0] != os.path.basename(path):
+            os.remove(os.path.join(CHECKPOINT_DIRECTORY, file))
+
+# resuming from the last training state, the weights being restored as the first step creates them
+state = load_arrays(STATE_PATH)
+if state is None:
+    start_epoch, first_batch, order, total_loss = 0, 0, None, 0
+    past_loss = 0
+    counter = 0
+    if COMPARE:
+        if COMPILED:
+            compare_training_steps()
+        compare_prefetching()
+        compare_bucketing()
+else:
+    if 'cudnn' in state and bool(state['cudnn']) != CUDNN:
+        saved, current = ('GRU', 'CuDNNGRU') if CUDNN else ('CuDNNGRU', 'GRU')
+        raise ValueError('The checkpoint in {} was saved by a {}, whose weights cannot be restored into the {} of this machine'.format(CHECKPOINT_DIRECTORY, saved, current))
+    checkpoint.restore(str(state['checkpoint']))
+    set_random_state(state)
+    start_epoch, first_batch = (EPOCHS if state['stopped'] else int(state['epoch'])), int(state['batch'])
+    # an epoch saved at its end is followed by a new order of batches
+    order, total_loss = (state['order'], float(state['total_loss'])) if first_batch else (None, 0)
+    past_loss = float(state['past_loss'])
+    counter = int(state['counter'])
+
+# recording the data wait, compute time, tokens and decoder steps of every training and decoding batch into metrics files, the training ones also served at localhost:8000/metrics
+# GPU kernels run asynchronously, so the compute time of a batch only ends when a later operation waits for it
+INSTRUMENT = False
+training_instrument = create_instrument('attention_training', INSTRUMENT, 'fr_en_attention_training_metrics.jsonl', port = 8000)
+decoding_instrument = create_instrument('attention_decoding', INSTRUMENT, 'fr_en_attention_decoding_metrics.jsonl')
+
+resume_tic = time.time()
+resuming = True
+
+for epoch in range(start_epoch, EPOCHS):
+    tic = time.time()
 
-            # using teacher forcing
-            for t in range(1, Y.shape[1]):
-                # passing encoder_output to the decoder
-                predictions, decoder_hidden, _ = decoder(decoder_input, decoder_hidden, encoder_output)
-                loss += loss_function(Y[:, t], predictions)
+    hidden = encoder.initialize_hidden_state()
+    if order is None:
+        order, first_batch, total_loss = epoch_order(), 0, 0
+    total_tokens = 0
 
-                # feeding the target as the next input
-                decoder_input = tf.expand_dims(Y[:, t], 1)
+    for (batch, (X, Y)) in enumerate(training_instrument.wrap(epoch_dataset(order, first_batch)), start = first_batch):
+        # the first step always runs eagerly, as it creates the variables of the encoder and the decoder
+        step = compiled_train_step if COMPILED and encoder.variables else train_step
+        loss, gradients = step(X, Y, hidden)
 
         total_loss += (loss / int(Y.shape[1]))
-        variables = encoder.variables + decoder.variables
-        gradients = tape.gradient(loss, variables)
-        optimizer.apply_gradients(zip(gradients, variables), tf.train.get_or_create_global_step())
+        tokens = np.count_nonzero(Y)
+        total_tokens += tokens
+        optimizer.apply_gradients(zip(gradients, encoder.variables + decoder.variables), tf.train.get_or_create_global_step())
+        training_instrument.batch_end(int(X.shape[0]), tokens, int(Y.shape[1]) - 1)
+
+        if resuming:
+            loss.numpy()
+            resuming = False
+            # reporting the time to resume, from loading the dataset to the end of the first batch trained with the restored weights
+            restore_seconds = time.time() - resume_tic
+            print('{} at epoch {} batch {} in {:.2f} seconds, {:.2f} to load the dataset and {:.2f} to restore and train the first batch'.format(
+                'Started' if state is None else 'Resumed', epoch + 1, batch + 1, dataset_seconds + restore_seconds, dataset_seconds, restore_seconds))
 
         if batch % 100 == 0:
             print('Epoch {} Batch {} Loss {:.4f}'.format(epoch + 1, batch + 1, loss.numpy() / int(Y.shape[1])))
 
+        if (batch + 1) % CHECKPOINT_EVERY == 0:
+            save_training_state(epoch, batch + 1, order, total_loss, past_loss, counter)
+
     toc = time.time()
 
     present_loss = total_loss / len(dataX)
-    print('Epoch {} Loss {:.4f} Time taken {:.2f} seconds'.format(epoch + 1, present_loss, toc - tic))
+    print('Epoch {} Loss {:.4f} Time taken {:.2f} seconds Tokens/sec {:.0f}'.format(epoch + 1, present_loss, toc - tic, total_tokens / (toc - tic)))
 
     if past_loss - present_loss >= 0.001:
         past_loss = present_loss
@@ -243,42 +390,92 @@ for epoch in range(EPOCHS):
         past_loss = present_loss
         counter += 1
 
+    order = None
+    save_training_state(epoch + 1, 0, np.zeros((0, BATCH_SIZE), dtype = np.int64), 0, past_loss, counter, stopped = counter == 5)
+
     if counter == 5:
         print("\nEarrlystopping at {} th epoch".format(epoch + 1))
         break
 
-def evaluate(sentence, ENCODER, DECODER, source_language, target_language, maximum_length_source, maximum_length_target):
-    attention_plot = np.zeros((maximum_length_target, maximum_length_source))
-
-    sentence = preprocess_sentence(sentence)
-    inputs = [source_language.word_to_index[word] for word in sentence.split(' ')]
-    inputs = tf.keras.preprocessing.sequence.pad_sequences([inputs], maxlen = maximum_length_source, padding = 'post')
-    inputs = tf.convert_to_tensor(inputs)
-    
-    result = ''
-
-    hidden = [tf.zeros((1, units))]
+# repeating every row of a tensor beam_width times, so that each beam of a sentence sees its own copy
+def tile_beams(tensor, beam_width):
+    multiples = [1, beam_width] + [1] * (len(tensor.shape) - 1)
+    return tf.reshape(tf.tile(tf.expand_dims(tensor, 1), multiples), tf.concat([[-1], tf.shape(tensor)[1:]], 0))
+
+# translating a batch of sentences with beam search, which is greedy decoding when beam_width is 1
+def decode_batch(sentences, ENCODER, DECODER, source_language, target_language, maximum_length_source, maximum_length_target, beam_width = 1, return_attention = False):
+    decoding_instrument.batch_start()
+    sentences = [preprocess_sentence(sentence) for sentence in sentences]
+    # the encoder and the attention have no mask, so the batch is padded only to its longest sentence rounded up to LENGTH_STEP, up to the maximum length, as each batch is in training
+    # words never seen in training are encoded as unknown instead of failing the lookup
+    length_source = bucket_length(max(len(sentence.split()) for sentence in sentences), LENGTH_STEP, maximum_length_source)
+    inputs = tf.convert_to_tensor(source_language.encode_batch(sentences, length_source))
+    decoding_instrument.data_ready()
+
+    n = len(sentences)
+    start_id, end_id = target_language.index('<start>'), target_language.index('<end>')
+
+    hidden = tf.zeros((n, units))
     encoder_output, encoder_hidden = ENCODER(inputs, hidden)
-    decoder_hidden = encoder_hidden
-    decoder_input = tf.expand_dims([target_language.word_to_index['<start>']], 0)
+    encoder_output = tile_beams(encoder_output, beam_width)
+    encoder_keys = DECODER.attention_keys(encoder_output)
+    decoder_hidden = tile_beams(encoder_hidden, beam_width)
+    decoder_input = tf.fill([n * beam_width], start_id)
+
+    # only the first beam of each sentence is alive at the start, so that the first step does not pick the same word beam_width times
+    scores = tf.tile(tf.constant([[0.0] + [-np.inf] * (beam_width - 1)]), [n, 1])
+    finished = tf.zeros([n * beam_width], dtype = tf.bool)
+    batch_offsets = tf.expand_dims(tf.range(n) * beam_width, 1)
+    history = tf.zeros([n * beam_width, 0], dtype = tf.int32)
+    attention_history = tf.zeros([n * beam_width, 0, length_source])
 
     for counter in range(maximum_length_target):
-        predictions, decoder_hidden, attention_weights = DECODER(decoder_input, decoder_hidden, encoder_output)
-
-        # storing the attention weigths to plot later on
-        attention_weights = tf.reshape(attention_weights, (-1, ))
-        attention_plot[counter] = attention_weights.numpy()
-
-        predicted_id = tf.multinomial(tf.exp(predictions), num_samples = 1)[0][0].numpy()
-        result += target_language.index_to_word[predicted_id] + ' '
-
-        if target_language.index_to_word[predicted_id] == '<end>':
-            return result, sentence, attention_plot
-
-        # the predicted ID is fed back into the model
-        decoder_input = tf.expand_dims([predicted_id], 0)
-
-    return result, sentence, attention_plot
+        predictions, decoder_hidden, attention_weights = DECODER.step(decoder_input, decoder_hidden, encoder_output, encoder_keys)
+        log_probabilities = tf.nn.log_softmax(predictions)
+        vocabulary_size = int(log_probabilities.shape[1])
+
+        # a finished beam can only be extended with padding, which keeps its score unchanged
+        padding_only = tf.one_hot(tf.zeros([n * beam_width], dtype = tf.int32), vocabulary_size, on_value = 0.0, off_value = -np.inf)
+        log_probabilities = tf.where(finished, padding_only, log_probabilities)
+
+        # keeping the best beam_width extensions among every beam of each sentence
+        candidates = tf.reshape(tf.expand_dims(scores, 2) + tf.reshape(log_probabilities, [n, beam_width, vocabulary_size]), [n, -1])
+        scores, indices = tf.nn.top_k(candidates, k = beam_width)
+        parents = tf.reshape(indices // vocabulary_size + batch_offsets, [-1])
+        decoder_input = tf.reshape(indices % vocabulary_size, [-1])
+
+        history = tf.concat([tf.gather(history, parents), tf.expand_dims(decoder_input, 1)], axis = 1)
+        if return_attention:
+            attention_history = tf.concat([tf.gather(attention_history, parents), tf.expand_dims(tf.gather(attention_weights[:, :, 0], parents), 1)], axis = 1)
+        decoder_hidden = tf.gather(decoder_hidden, parents)
+        finished = tf.logical_or(tf.gather(finished, parents), tf.equal(decoder_input, end_id))
+
+        # stopping early once every beam of every sentence has produced <end>
+        if tf.reduce_all(finished).numpy():
+            break
+
+    # top_k sorts the beams, so the first beam of each sentence is its best translation
+    # each translation ends before its <end> token, as the translations of the inference bundle do, while its attention plot keeps the step that produced <end>
+    history = history.numpy()[::beam_width]
+    ends = history == end_id
+    lengths = np.where(ends.any(axis = 1), ends.argmax(axis = 1), history.shape[1])
+    steps = np.minimum(lengths + 1, history.shape[1])
+    results = target_language.decode_batch(history, lengths)
+    decoding_instrument.batch_end(n, steps.sum(), counter + 1)
+
+    if not return_attention:
+        return results, sentences, None
+
+    attention_history = attention_history.numpy()[::beam_width]
+    attention_plots = np.zeros((n, maximum_length_target, length_source))
+    for attention_plot, attention, length in zip(attention_plots, attention_history, steps):
+        attention_plot[:length] = attention[:length]
+
+    return results, sentences, attention_plots
+
+def evaluate(sentence, ENCODER, DECODER, source_language, target_language, maximum_length_source, maximum_length_target, beam_width = 1):
+    results, sentences, attention_plots = decode_batch([sentence], ENCODER, DECODER, source_language, target_language, maximum_length_source, maximum_length_target, beam_width, return_attention = True)
+    return results[0], sentences[0], attention_plots[0]
 
 # function for plotting the attention weights
 def plot_attention(attention, sentence, predicted_sentence):
@@ -302,12 +499,32 @@ def translate(source, ENCODER, DECODER, source_language, target_language, maximu
         attention_plot = attention_plot[:len(result.split(' ')), :len(source.split(' '))]
         plot_attention(attention_plot, source.split(' '), result.split(' '))
 
-# showing examples of model performance
-for counter, language_pair in enumerate(data):
-    if counter % 2500 == 0:
-        translate(language_pair[1][len('<start> ') : -len(' <end>')], encoder, decoder, vocabX, vocabY, sizeX, sizeY)
-        print('Target: {} \n'.format(language_pair[0][len('<start> '):]))
+# showing examples of model performance, translated in a single batch
+examples = data[::2500]
+results, sources, _ = decode_batch([source[len('<start> ') : -len(' <end>')] for target, source in examples], encoder, decoder, vocabX, vocabY, sizeX, sizeY)
+for (target, _), result, source in zip(examples, results, sources):
+    print('Source: {}'.format(source))
+    print('Result: {}'.format(result))
+    print('Target: {} \n'.format(target[len('<start> ') : -len(' <end>')]))
 
 # showing attention plot
 print('_' * 75, '\n')
-translate("Je cherche de l'eau.", encoder, decoder, vocabX, vocabY, sizeX, sizeY, True)
\ No newline at end of file
+translate("Je cherche de l'eau.", encoder, decoder, vocabX, vocabY, sizeX, sizeY, True)
+
+# exporting the trained translator with its vocabularies and float16 weights into a bundle that runs in numpy, without tensorflow or a GPU
+# the lines of the corpus after the reduced dataset were never trained on, and the bundle keeps a quantization, int8 included, only if its greedy translations of them agree with the trained model
+QUANTIZATION = 'float16'
+held_out = [source for target, source in preprocess_pairs(list(itertools.islice(read_lines('fra.txt', reduced_size + 500), reduced_size, None)))]
+expected, _, _ = decode_batch(held_out, encoder, decoder, vocabX, vocabY, sizeX, sizeY)
+quantization, agreement = export_checked(lambda path, quantization: export_attention_translator(encoder, decoder, vocabX, vocabY, sizeX, sizeY, path, quantization, LENGTH_STEP),
+                                         'fr_en_attention_bundle.npz', held_out, expected, QUANTIZATION)
+print('Bundle weights: {} \t Same as the trained model on {} held out sentences: {:.1f}%'.format(quantization or 'float32', len(held_out), 100 * agreement))
+print('Bundle result: {}'.format(load_translator('fr_en_attention_bundle.npz').translate(["Je cherche de l'eau."])[0]))
+files.download('fr_en_attention_bundle.npz')
+
+# downloading the metrics of the instrumented runs
+if INSTRUMENT:
+    training_instrument.close()
+    decoding_instrument.close()
+    files.download('fr_en_attention_training_metrics.jsonl')
+    files.download('fr_en_attention_decoding_metrics.jsonl')
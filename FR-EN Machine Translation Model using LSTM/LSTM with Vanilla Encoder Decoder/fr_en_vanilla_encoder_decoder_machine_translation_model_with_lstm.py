@@ -8,71 +8,34 @@ Original file is located at
 """
 
 # importing required modules
-import matplotlib.pyplot as plt, re
+import matplotlib.pyplot as plt
+from collections import OrderedDict
 from google.colab import files
 from keras.callbacks import EarlyStopping, ModelCheckpoint
 from keras.layers import Dense, Embedding, LSTM, RepeatVector, TimeDistributed
 from keras.models import load_model, Sequential
-from keras.preprocessing.sequence import pad_sequences
-from keras.preprocessing.text import Tokenizer
-from keras.utils import to_categorical
-from numpy import argmax, array, empty, mean
+from keras.utils import Sequence
+from numpy import arange, argmax, array, count_nonzero, expand_dims, mean
+from numpy.random import permutation
 from os import listdir, remove
 from os.path import isfile, join
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.model_selection import train_test_split
-from unicodedata import category, normalize
-
-# removing the accents
-def unicode_to_ascii(string):
-    return ''.join(character for character in normalize('NFD', string) if category(character) != 'Mn')
-
-# cleaning a sentence
-def preprocess_sentence(line):
-    # converting from unicode to ascii
-    line = unicode_to_ascii(line.lower().strip())
-    # creating a space between a word and the punctuation following it, and then collapsing multiple spaces
-    line = re.sub(r'[" "]+', " ", re.sub(r"([!',-.0-9?])", r" \1 ", line))
-    # replacing everything with space except a-z, A-Z, "!", "'", ",", "-", ".", "?"
-    line = re.sub(r"[^a-zA-Z!',-.0-9?]+", " ", line).strip()
-    return line
 
 # creating line pairs in the format: [target, source]
-def create_dataset(filename, size):
-    # open the file as read only, read all text and split in lines
-    pairs = open(filename, mode = 'rt', encoding='UTF-8').read().strip().split('\n')
-    # reducing dataset, splitting into target - source pairs and cleaning
-    line_pairs = [[preprocess_sentence(line) for line in pair.split('\t')] for pair in pairs[:size]]
-    return array(line_pairs)
+def create_dataset(filename, size, n_processes = None, chunk_size = 1000):
+    return array(list(stream_dataset(filename, size, False, n_processes, chunk_size)))
 
 # finding maximum sentence length
 def maximum_length(lines):
     return max(len(line.split()) for line in lines)
 
-# creating a tokenizer to vectorize the sequence
-def create_tokenizer(lines):
-    tokenizer = Tokenizer(filters = '"#$%&()*+/:;<=>@[\]^_`{|}~')
-    tokenizer.fit_on_texts(lines)
-    return tokenizer
-
-# encoding and padding the sequence to the maximum length
-def encode_sequences(tokenizer, length, lines):
-    # encoding sequence to integers
-    X = tokenizer.texts_to_sequences(lines)
-    # padding sequence with 0 values
-    X = pad_sequences(X, maxlen = length, padding = 'post')
-    return X
-
-# performing one hot encode on target sequence
-def encode_output(sequences, vocab_size):
-    ylist = []
-    for sequence in sequences:
-        encoded = to_categorical(sequence, num_classes = vocab_size)
-        ylist.append(encoded)
-    y = array(ylist)
-    y = y.reshape(sequences.shape[0], sequences.shape[1], vocab_size)
-    return y
+# encoding and padding the sequence to the maximum length, with 0 values for padding
+def encode_sequences(vocabulary, length, lines):
+    return vocabulary.encode_batch(lines, length)
+
+# keeping target sequences as integers with a trailing axis for the sparse categorical loss, instead of one hot encoding them
+def encode_output(sequences):
+    return expand_dims(sequences, -1)
 
 # loading training and testing data
 def load_dataset(filename, size, shuffle_state = True, test_proportion = 0.2):
@@ -80,88 +43,133 @@ def load_dataset(filename, size, shuffle_state = True, test_proportion = 0.2):
     combined_dataset = create_dataset(filename, size)
     # shuffling and splitting into training and testing subsets
     training_dataset, testing_dataset = train_test_split(combined_dataset, shuffle = shuffle_state, test_size = test_proportion)
-    # preparing target tokenizer
-    target_tokenizer = create_tokenizer(combined_dataset[:, 0])
-    target_vocabulary_size = len(target_tokenizer.word_index) + 1
+    # preparing target vocabulary
+    target_vocabulary = Vocabulary.fit(combined_dataset[:, 0])
+    target_vocabulary_size = len(target_vocabulary)
     maximum_target_length = maximum_length(combined_dataset[:, 0])
-    # preparing source tokenizer
-    source_tokenizer = create_tokenizer(combined_dataset[:, 1])
-    source_vocabulary_size = len(source_tokenizer.word_index) + 1
+    # preparing source vocabulary
+    source_vocabulary = Vocabulary.fit(combined_dataset[:, 1])
+    source_vocabulary_size = len(source_vocabulary)
     maximum_source_length = maximum_length(combined_dataset[:, 1])
     # preparing training data
-    training_source = encode_sequences(source_tokenizer, maximum_source_length, training_dataset[:, 1])
-    training_target = encode_sequences(target_tokenizer, maximum_target_length, training_dataset[:, 0])
-    training_target = encode_output(training_target, target_vocabulary_size)
+    training_source = encode_sequences(source_vocabulary, maximum_source_length, training_dataset[:, 1])
+    training_target = encode_sequences(target_vocabulary, maximum_target_length, training_dataset[:, 0])
+    training_target = encode_output(training_target)
     # preparing testing data
-    testing_source = encode_sequences(source_tokenizer, maximum_source_length, testing_dataset[:, 1])
-    testing_target = encode_sequences(target_tokenizer, maximum_target_length, testing_dataset[:, 0])
-    testing_target = encode_output(testing_target, target_vocabulary_size)
+    testing_source = encode_sequences(source_vocabulary, maximum_source_length, testing_dataset[:, 1])
+    testing_target = encode_sequences(target_vocabulary, maximum_target_length, testing_dataset[:, 0])
+    testing_target = encode_output(testing_target)
     # printing dataset information
     print('Source Vocabulary Size: %d' % source_vocabulary_size)
     print('Source Maximum Length: %d' % maximum_source_length)
     print('Target Vocabulary Size: %d' % target_vocabulary_size)
     print('Target Maximum Length: %d' % maximum_target_length)
-    return combined_dataset, training_dataset, testing_dataset, training_source, training_target, testing_source, testing_target, source_vocabulary_size, target_vocabulary_size, maximum_source_length, maximum_target_length, source_tokenizer, target_tokenizer
+    return combined_dataset, training_dataset, testing_dataset, training_source, training_target, testing_source, testing_target, source_vocabulary_size, target_vocabulary_size, maximum_source_length, maximum_target_length, source_vocabulary, target_vocabulary
+
+# serving length bucketed batches, with source sequences padded only to the longest sentence of each batch
+# without bucketing, batches are drawn at random and keep the padding to the longest sentence of the corpus, as before bucketing
+class BucketedSequence(Sequence):
+    def __init__(self, source, target, batch_size, shuffle = True, bucketing = True):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucketing = bucketing
+        self.source_lengths = sequence_lengths(source)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        indices = self.batches[index]
+        if not self.bucketing:
+            return self.source[indices], self.target[indices]
+        return trim_batch(self.source, self.source_lengths, indices), self.target[indices]
 
-# defining encoder decoder neural machine translation model
-def define_model(source_vocabulary, target_vocabulary, source_timesteps, target_timesteps, n_units):
+    # regrouping the sentences after every epoch, as target sequences keep their full length only source lengths are bucketed
+    def on_epoch_end(self):
+        if self.bucketing:
+            self.batches = bucket_batches((self.source_lengths,), self.batch_size, self.shuffle)
+        else:
+            order = permutation(len(self.source)) if self.shuffle else arange(len(self.source))
+            self.batches = [order[start : start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+# defining encoder decoder neural machine translation model, accepting source sequences of any length
+def define_model(source_vocabulary, target_vocabulary, target_timesteps, n_units):
     model = Sequential()
-    model.add(Embedding(source_vocabulary, n_units, input_length = source_timesteps, mask_zero = True))
+    model.add(Embedding(source_vocabulary, n_units, mask_zero = True))
     model.add(LSTM(n_units))
     model.add(RepeatVector(target_timesteps))
     model.add(LSTM(n_units, return_sequences = True))
     model.add(TimeDistributed(Dense(target_vocabulary, activation = 'softmax')))
     return model
 
-# mapping an integer to a word
-def word_for_id(integer, tokenizer):
-    for word, index in tokenizer.word_index.items():
-        if index == integer:
-            return word
-    return None
-
-# generating target sequence given source sequence
-def predict_sequence(model, target_tokenizer, source):
-    prediction = model.predict(source, verbose = 0)[0]
-    integers = [argmax(vector) for vector in prediction]
-    target = []
-    for i in integers:
-        word = word_for_id(i, target_tokenizer)
-        if word is None:
-            break
-        target.append(word)
-    return ' '.join(target)
-    
+# generating target sequences given a batch of source sequences, each translation stopping at its first padding index
+def predict_sequences(model, target_vocabulary, sources, batch_size = 256):
+    integers = argmax(model.predict(sources, batch_size = batch_size, verbose = 0), axis = -1)
+    return target_vocabulary.decode_batch(integers)
+
+# translating lists of sentences in large batches, remembering the most recent translations
+class BatchTranslator():
+    def __init__(self, model, source_vocabulary, target_vocabulary, maximum_source_length, batch_size = 256, cache_size = 10000):
+        self.model = model
+        self.source_vocabulary = source_vocabulary
+        self.target_vocabulary = target_vocabulary
+        self.maximum_source_length = maximum_source_length
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    # decoding already encoded source sequences, one chunk at a time to bound the size of the predicted probabilities
+    def predict_encoded(self, encoded_sources):
+        translations = []
+        for start in range(0, len(encoded_sources), self.batch_size):
+            translations.extend(predict_sequences(self.model, self.target_vocabulary, encoded_sources[start : start + self.batch_size], self.batch_size))
+        return translations
+
+    def translate(self, sources):
+        sentences = [normalize_sentence(source.strip()) for source in sources]
+        # only sentences that are neither cached nor repeated in this call are encoded and predicted
+        pending = [sentence for sentence in dict.fromkeys(sentences) if sentence not in self.cache]
+        if pending:
+            encoded_sources = encode_sequences(self.source_vocabulary, self.maximum_source_length, pending)
+            for sentence, translation in zip(pending, self.predict_encoded(encoded_sources)):
+                self.cache[sentence] = translation
+        translations = []
+        for sentence in sentences:
+            self.cache.move_to_end(sentence)
+            translations.append(self.cache[sentence])
+        # discarding the least recently used translations
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+        return translations
+
 # evaluating a fitted model
-def evaluate_model(model, target_tokenizer, testing_source, testing_target, testing_dataset):
-    cosine_similarities = empty(len(testing_target))
-    for i, source in enumerate(testing_source):
-        # decoding predicted translations of encoded source text
-        source = source.reshape((1, source.shape[0]))
-        prediction = predict_sequence(model, target_tokenizer, source)
-        target = testing_dataset[i][0]
-        # calculating cosine similarity
-        vectorisations = TfidfVectorizer().fit_transform([prediction, target])
-        cosine_similarities[i] = cosine_similarity(vectorisations[0,], vectorisations[1,])
+def evaluate_model(translator, testing_source, testing_target, testing_dataset):
+    # decoding predicted translations of encoded source text
+    predictions = translator.predict_encoded(testing_source)
+    # calculating cosine similarities and BLEU over the whole test set at once
+    similarities = cosine_similarities(predictions, testing_dataset[:, 0])
+    bleu = corpus_bleu(predictions, testing_dataset[:, 0])
     # checking model performance
-    metrics = model.evaluate(testing_source, testing_target, verbose = 0)
+    metrics = translator.model.evaluate(testing_source, testing_target, verbose = 0)
     # printing results
-    print("Average Cosine Similarity: %.2f" % mean(cosine_similarities))
-    print("Model %s: %.2f%%" % (model.metrics_names[1], metrics[1] * 100))
+    print("Average Cosine Similarity: %.2f" % mean(similarities))
+    print("Corpus BLEU: %.2f" % bleu)
+    print("Model %s: %.2f%%" % (translator.model.metrics_names[1], metrics[1] * 100))
 
 # translating source language text to target language text
-def translate(source, model, source_tokenizer, target_tokenizer, maximum_source_length):
-    encoded_source = encode_sequences(source_tokenizer, maximum_source_length, array([preprocess_sentence(source.strip())]))[0]
-    decoded_translation = predict_sequence(model, target_tokenizer, encoded_source.reshape((1, encoded_source.shape[0])))
-    return(decoded_translation)
+def translate(source, translator):
+    return translator.translate([source])[0]
 
 # visualising a fitted model
-def visualise_model(model, history, name, combined_dataset, source_tokenizer, target_tokenizer, maximum_source_length):
-    print(model.summary())
+def visualise_model(translator, history, name, combined_dataset):
+    print(translator.model.summary())
     # plotting progress
-    plt.plot(history.history['categorical_accuracy'])
+    plt.plot(history.history['sparse_categorical_accuracy'])
     plt.plot(history.history['loss'])
-    plt.plot(history.history['val_categorical_accuracy'])
+    plt.plot(history.history['val_sparse_categorical_accuracy'])
     plt.plot(history.history['val_loss'])
     plt.title('Improvement during Training')
     plt.ylabel('Model Metrics')
@@ -169,12 +177,12 @@ def visualise_model(model, history, name, combined_dataset, source_tokenizer, ta
     plt.legend(['training accuracy', 'training loss', 'validation accuracy', 'validation loss'], loc = 'best')
     plt.savefig('%s_progress.png' % name)
     plt.close()
-    for counter, language_pair in enumerate(combined_dataset):
-        if counter % 2500 == 0:
-            input_text = language_pair[1]
-            expected_text = language_pair[0]
-            output_text = translate(language_pair[1], model, source_tokenizer, target_tokenizer, maximum_source_length)
-            print('source: [%s] \t target: [%s] \t result: [%s]' % (input_text, expected_text, output_text))
+    examples = combined_dataset[::2500]
+    output_texts = translator.translate(examples[:, 1])
+    for language_pair, output_text in zip(examples, output_texts):
+        input_text = language_pair[1]
+        expected_text = language_pair[0]
+        print('source: [%s] \t target: [%s] \t result: [%s]' % (input_text, expected_text, output_text))
 
 # removing all existing files
 files_in_directory = [file for file in listdir('.') if isfile(join('.', file))]
@@ -184,24 +192,80 @@ for counter in files_in_directory:
 # uploading file
 uploaded = files.upload()
 
+# importing the shared modules uploaded alongside the dataset
+from text_normalizer import normalize_sentence
+from corpus_loader import stream_dataset
+from bucketing import bucket_batches, padding_report, sequence_lengths, trim_batch
+from corpus_metrics import corpus_bleu, cosine_similarities
+from vocabulary import Vocabulary
+from inference_bundle import export_checked, export_sequential_translator
+from instrumentation import create_instrument
+
 # loading reduced dataset
 n_sentences = 35000
-combined, train, test, trainX, trainY, testX, testY, vocabX, vocabY, sizeX, sizeY, tokenX, tokenY = load_dataset('fra.txt', n_sentences)
+combined, train, test, trainX, trainY, testX, testY, vocabX, vocabY, sizeX, sizeY, vocabularyX, vocabularyY = load_dataset('fra.txt', n_sentences)
 
 # defining model
-fr_en_ed_model = define_model(vocabX, vocabY, sizeX, sizeY, 256)
-fr_en_ed_model.compile(optimizer = 'adam', loss = 'categorical_crossentropy', metrics = ['categorical_accuracy'])
+fr_en_ed_model = define_model(vocabX, vocabY, sizeY, 256)
+fr_en_ed_model.compile(optimizer = 'adam', loss = 'sparse_categorical_crossentropy', metrics = ['sparse_categorical_accuracy'])
 
 # setting callbacks to for the model during training
 checkpoint = ModelCheckpoint(filepath = 'fr_en_ed_model.h5', save_best_only = True, verbose = 1)
 earlystop = EarlyStopping(min_delta = 0.001, patience = 5, verbose = 1)
 
+# holding out the last quarter of the training data for validation and batching both parts by source length
+split = int(len(trainX) * 0.75)
+training_batches = BucketedSequence(trainX[:split], trainY[:split], 64)
+validation_batches = BucketedSequence(trainX[split:], trainY[split:], 64, shuffle = False)
+padding_report((training_batches.source_lengths,), training_batches.batches)
+
+# timing an epoch of a fresh model on length bucketed batches against one on batches padded to the longest sentence of the corpus, in real tokens per second
+# the tokens of a sentence are its source and target words, and each model trains on one batch first so that building its training function is not timed
+COMPARE_BUCKETING = False
+def compare_bucketing(source, target, batch_size = 64):
+    tokens_per_item = (count_nonzero(source) + count_nonzero(target)) / len(source)
+    for bucketing in (False, True):
+        model = define_model(vocabX, vocabY, sizeY, 256)
+        model.compile(optimizer = 'adam', loss = 'sparse_categorical_crossentropy', metrics = ['sparse_categorical_accuracy'])
+        batches = BucketedSequence(source, target, batch_size, bucketing = bucketing)
+        model.train_on_batch(*batches[0])
+        timing = create_instrument('bucketing')
+        model.fit_generator(batches, epochs = 1, callbacks = timing.keras_callbacks(tokens_per_item = tokens_per_item), verbose = 0)
+        print('Bucketing %s \t %.0f tokens/sec \t %.1f seconds/epoch' % (bucketing, timing.totals['tokens'] / timing.totals['batch_seconds'], timing.totals['batch_seconds']))
+
+if COMPARE_BUCKETING:
+    compare_bucketing(trainX[:split], trainY[:split])
+
+# recording the data wait, compute time and tokens of every training batch into a metrics file also served at localhost:8000/metrics
+# the decoder runs for all the target timesteps of every batch, and the tokens of a batch are counted at the average number of target tokens per sentence
+INSTRUMENT = False
+instrument = create_instrument('vanilla_training', INSTRUMENT, 'fr_en_ed_training_metrics.jsonl', port = 8000)
+instrument_callbacks = instrument.keras_callbacks(tokens_per_item = count_nonzero(trainY) / len(trainY), decoder_steps = sizeY)
+
 # fitting and visualising and evaluating the model
-fr_en_ed_progress = fr_en_ed_model.fit(trainX, trainY, epochs = 100, batch_size = 64, validation_split = 0.25, callbacks = [checkpoint, earlystop], verbose = 0)
+fr_en_ed_progress = fr_en_ed_model.fit_generator(training_batches, epochs = 100, validation_data = validation_batches, callbacks = [checkpoint, earlystop] + instrument_callbacks, verbose = 0)
+instrument.close()
 fr_en_ed_model = load_model('fr_en_ed_model.h5')
-evaluate_model(fr_en_ed_model, tokenY, testX, testY, test)
-visualise_model(fr_en_ed_model, fr_en_ed_progress, 'fr_en_ed', combined, tokenX, tokenY, sizeX)
+fr_en_ed_translator = BatchTranslator(fr_en_ed_model, vocabularyX, vocabularyY, sizeX)
+evaluate_model(fr_en_ed_translator, testX, testY, test)
+visualise_model(fr_en_ed_translator, fr_en_ed_progress, 'fr_en_ed', combined)
+
+# saving the vocabularies, which translators memory map instead of refitting them on the corpus
+vocabularyX.save('fr_en_ed_source_vocabulary.npy')
+vocabularyY.save('fr_en_ed_target_vocabulary.npy')
+
+# exporting the model with its vocabularies and float16 weights into a bundle that runs in numpy, without keras
+# the bundle keeps a quantization, int8 included, only if its translations of the test sentences agree with the trained model
+QUANTIZATION = 'float16'
+quantization, agreement = export_checked(lambda path, quantization: export_sequential_translator(fr_en_ed_model, vocabularyX, vocabularyY, sizeX, path, quantization),
+                                         'fr_en_ed_bundle.npz', test[:, 1], fr_en_ed_translator.translate(test[:, 1]), QUANTIZATION)
+print('Bundle weights: %s \t Same as the trained model on %d test sentences: %.1f%%' % (quantization or 'float32', len(test), 100 * agreement))
 
 # downloading files
 files.download('fr_en_ed_progress.png')
-files.download('fr_en_ed_model.h5')
\ No newline at end of file
+files.download('fr_en_ed_model.h5')
+files.download('fr_en_ed_source_vocabulary.npy')
+files.download('fr_en_ed_target_vocabulary.npy')
+files.download('fr_en_ed_bundle.npz')
+if INSTRUMENT:
+    files.download('fr_en_ed_training_metrics.jsonl')
\ No newline at end of file
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Length bucketed batching shared by the FR - EN machine translation models"""
+
+import numpy as np
+
+# finding the number of tokens in each post padded sequence
+def sequence_lengths(tensor):
+    return np.count_nonzero(tensor, axis = 1)
+
+# grouping indices of sentences of similar lengths into batches, sorting on the first array of lengths and breaking ties with the next ones
+def bucket_batches(lengths, batch_size, shuffle = True, drop_remainder = False):
+    order = np.random.permutation(len(lengths[0])) if shuffle else np.arange(len(lengths[0]))
+
+    # dropping a random remainder, so that the longest sentences are not the ones always left out
+    if drop_remainder:
+        order = order[:len(order) - len(order) % batch_size]
+
+    # the sort is stable, so sentences of equal lengths keep their random order
+    order = order[np.lexsort([length[order] for length in reversed(lengths)])]
+    batches = [order[start : start + batch_size] for start in range(0, len(order), batch_size)]
+
+    if shuffle:
+        np.random.shuffle(batches)
+
+    return batches
+
+# rounding a length up to a multiple of step, up to maximum_length, so that batches only come in a few lengths and a traced graph is reused for each of them
+def bucket_length(length, step, maximum_length):
+    return min(-(-int(length) // step) * step, int(maximum_length))
+
+# selecting the sentences of a batch and trimming their padding to the longest one among them, rounded up to a multiple of step
+def trim_batch(tensor, lengths, indices, step = 1):
+    return tensor[indices, :bucket_length(lengths[indices].max(), step, tensor.shape[1])]
+
+# comparing the timesteps computed with corpus wide padding against the ones computed with length bucketed padding
+def padding_report(lengths, batches, step = 1):
+    indices = np.concatenate(batches)
+    tokens = sum(length[indices].sum() for length in lengths)
+    padded = len(indices) * sum(length.max() for length in lengths)
+    bucketed = sum(len(batch) * sum(bucket_length(length[batch].max(), step, length.max()) for length in lengths) for batch in batches)
+    print('Tokens: {} \t Padded timesteps: {} ({:.1%} padding) \t Bucketed timesteps: {} ({:.1%} padding)'.format(tokens, padded, 1 - tokens / padded, bucketed, 1 - tokens / bucketed))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Streaming corpus loader shared by the FR - EN machine translation models"""
+
+import collections, functools, itertools, multiprocessing, os
+from text_normalizer import normalize_sentence
+
+# reading the first size non empty lines of a file lazily, without reading the rest of it
+def read_lines(filepath, size):
+    with open(filepath, mode = 'rt', encoding = 'UTF-8') as file:
+        yield from itertools.islice((line.strip() for line in file if not line.isspace()), size)
+
+# splitting an iterable into lists of at most chunk_size elements
+def chunk_iterable(iterable, chunk_size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+# splitting a chunk of lines into target - source pairs and cleaning them, adding start and end tokens to every sentence if add_tokens
+def preprocess_pairs(pairs, add_tokens = False):
+    return [[normalize_sentence(line, add_tokens) for line in pair.split('\t')] for pair in pairs]
+
+# generating cleaned line pairs in the format: [target, source], with chunks of lines cleaned in parallel across a process pool
+# at most max_pending chunks, two per process by default, are read ahead of the one being generated, as imap would queue every chunk of the file at once
+def stream_dataset(filepath, size, add_tokens = False, n_processes = None, chunk_size = 1000, max_pending = None):
+    process = functools.partial(preprocess_pairs, add_tokens = add_tokens)
+    max_pending = max_pending or 2 * (n_processes or os.cpu_count() or 1)
+    pending = collections.deque()
+    with multiprocessing.Pool(n_processes) as pool:
+        for chunk in chunk_iterable(read_lines(filepath, size), chunk_size):
+            pending.append(pool.apply_async(process, (chunk, )))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
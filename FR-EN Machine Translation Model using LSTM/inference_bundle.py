@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""Self contained inference bundles for the FR - EN machine translation models
+
+A bundle is a single .npz file with the weights of a trained translator,
+optionally quantized to int8 or float16, its vocabularies and the settings
+needed to run it. Loading a bundle needs only numpy and the shared text
+normalizer, vocabulary and bucketing: the layers run in numpy on the CPU, so serving
+processes import neither tensorflow, keras nor the training scripts, and
+models trained with CuDNNGRU run on machines without a GPU.
+
+Running this file directly exports translators with random weights in every
+quantization and compares their size, cold start, peak memory and per sentence
+latency, with the keras .h5 path alongside when keras is installed. Random
+weights leave many near ties between words, so the agreement of quantized
+translations with float32 ones says little about a trained model: the training
+scripts export through export_checked, which measures it on held out sentences
+against the trained model and keeps a quantization only where it holds.
+"""
+
+import json, numpy as np, os, sys, tempfile, time
+# quantize, dequantize and cold_start are shared with the speech classifier bundles, in bundle_tools.py at the root of the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bundle_tools import cold_start, dequantize, quantize
+from bucketing import bucket_length
+from instrumentation import NullInstrument
+from text_normalizer import normalize_sentence
+from vocabulary import Vocabulary
+
+# writing the settings, the weights and the vocabularies of a translator into one file, the settings as a json string so that loading never unpickles
+# every bias is named after its role, ending in bias, and is kept in float32
+def save_bundle(path, config, weights, vocabularies, quantization = None):
+    arrays = {'config': np.array(json.dumps(dict(config, quantization = quantization)))}
+    for name, value in weights.items():
+        arrays['weights/' + name], scale = quantize(value, quantization, bias = name.endswith('bias'))
+        if scale is not None:
+            arrays['scales/' + name] = scale
+    for name, vocabulary in vocabularies.items():
+        arrays['vocabularies/' + name] = np.asarray(vocabulary.words)
+    with open(path, 'wb') as file:
+        np.savez(file, **arrays)
+
+def load_bundle(path):
+    weights, vocabularies = {}, {}
+    with np.load(path, allow_pickle = False) as bundle:
+        config = json.loads(str(bundle['config']))
+        for key in bundle.files:
+            kind, _, name = key.partition('/')
+            if kind == 'weights':
+                weights[name] = dequantize(bundle[key], bundle['scales/' + name] if 'scales/' + name in bundle.files else None)
+            elif kind == 'vocabularies':
+                vocabularies[name] = Vocabulary(bundle[key])
+    return config, weights, vocabularies
+
+activations = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+}
+
+def softmax(x, axis = -1):
+    x = np.exp(x - x.max(axis = axis, keepdims = True))
+    return x / x.sum(axis = axis, keepdims = True)
+
+# running one step of a keras LSTM from the input projection of the step, with gates in the keras order i, f, c, o
+def lstm_step(projection, hidden, cell, recurrent_kernel, activation, recurrent_activation):
+    z = projection + hidden @ recurrent_kernel
+    i, f, c, o = np.split(z, 4, axis = -1)
+    cell = recurrent_activation(f) * cell + recurrent_activation(i) * activation(c)
+    return recurrent_activation(o) * activation(cell), cell
+
+# running one step of a GRU with the reset gate applied after the recurrent projection, which is what CuDNNGRU computes, with gates in the keras order z, r, h
+def gru_step(projection, hidden, recurrent_kernel, recurrent_bias):
+    x_z, x_r, x_h = np.split(projection, 3, axis = -1)
+    h_z, h_r, h_h = np.split(hidden @ recurrent_kernel + recurrent_bias, 3, axis = -1)
+    z = activations['sigmoid'](x_z + h_z)
+    r = activations['sigmoid'](x_r + h_r)
+    return z * hidden + (1 - z) * np.tanh(x_h + r * h_h)
+
+# splitting the bias of a CuDNNGRU, of shape (6 * units, ), or of a GRU with reset_after, of shape (2, 3 * units), into its input and recurrent halves
+def gru_biases(bias):
+    return bias.reshape(2, -1)
+
+# translating with the embedding, LSTM, RepeatVector, LSTM and TimeDistributed Dense layers of the vanilla encoder decoder
+# the instrument of a translator, disabled unless one is assigned, sees each call to translate as a batch whose data wait is the encoding
+class SequentialTranslator():
+    instrument = NullInstrument()
+
+    def __init__(self, config, weights, vocabularies):
+        self.config = config
+        self.weights = weights
+        self.source_vocabulary, self.target_vocabulary = vocabularies['source'], vocabularies['target']
+        self.encoder_activations = activations[config['encoder_activation']], activations[config['encoder_recurrent_activation']]
+        self.decoder_activations = activations[config['decoder_activation']], activations[config['decoder_recurrent_activation']]
+
+    def predict_encoded(self, sources):
+        w = self.weights
+        n, units = len(sources), w['encoder_recurrent_kernel'].shape[0]
+        # projecting every timestep of the source at once, the mask of padded ids keeping the state of the last word
+        projections = w['embedding'][sources] @ w['encoder_kernel'] + w['encoder_bias']
+        mask = sources != 0 if self.config['mask_zero'] else np.ones(sources.shape, dtype = bool)
+        hidden, cell = np.zeros((n, units), dtype = np.float32), np.zeros((n, units), dtype = np.float32)
+        for t in range(sources.shape[1]):
+            new_hidden, new_cell = lstm_step(projections[:, t], hidden, cell, w['encoder_recurrent_kernel'], *self.encoder_activations)
+            hidden, cell = np.where(mask[:, t:t + 1], new_hidden, hidden), np.where(mask[:, t:t + 1], new_cell, cell)
+        # the repeated vector is the same at every timestep of the decoder, so it is projected only once
+        projection = hidden @ w['decoder_kernel'] + w['decoder_bias']
+        hidden, cell = np.zeros((n, units), dtype = np.float32), np.zeros((n, units), dtype = np.float32)
+        outputs = np.empty((n, self.config['target_timesteps']), dtype = np.int32)
+        for t in range(self.config['target_timesteps']):
+            hidden, cell = lstm_step(projection, hidden, cell, w['decoder_recurrent_kernel'], *self.decoder_activations)
+            outputs[:, t] = np.argmax(hidden @ w['dense_kernel'] + w['dense_bias'], axis = -1)
+        self.instrument.batch_end(n, np.count_nonzero(outputs), self.config['target_timesteps'])
+        return self.target_vocabulary.decode_batch(outputs)
+
+    def translate(self, sentences):
+        self.instrument.batch_start()
+        sentences = [normalize_sentence(sentence.strip()) for sentence in sentences]
+        sources = self.source_vocabulary.encode_batch(sentences, self.config['maximum_source_length'])
+        self.instrument.data_ready()
+        return self.predict_encoded(sources)
+
+# translating greedily with the GRU encoder and the GRU decoder with Bahdanau attention of the attention model
+class AttentionTranslator():
+    instrument = NullInstrument()
+
+    def __init__(self, config, weights, vocabularies):
+        self.config = config
+        self.weights = weights
+        self.source_vocabulary, self.target_vocabulary = vocabularies['source'], vocabularies['target']
+        self.encoder_biases = gru_biases(weights['encoder_gru_bias'])
+        self.decoder_biases = gru_biases(weights['decoder_gru_bias'])
+
+    def predict_encoded(self, sources):
+        w = self.weights
+        n, units = len(sources), w['encoder_gru_recurrent_kernel'].shape[0]
+        projections = w['encoder_embedding'][sources] @ w['encoder_gru_kernel'] + self.encoder_biases[0]
+        encoder_output = np.empty((n, sources.shape[1], units), dtype = np.float32)
+        hidden = np.zeros((n, units), dtype = np.float32)
+        for t in range(sources.shape[1]):
+            hidden = encoder_output[:, t] = gru_step(projections[:, t], hidden, w['encoder_gru_recurrent_kernel'], self.encoder_biases[1])
+        encoder_keys = encoder_output @ w['W1_kernel'] + w['W1_bias']
+
+        start_id, end_id = self.target_vocabulary.index('<start>'), self.target_vocabulary.index('<end>')
+        ids = np.full(n, start_id, dtype = np.int32)
+        finished = np.zeros(n, dtype = bool)
+        history = np.zeros((n, self.config['maximum_target_length']), dtype = np.int32)
+        zeros = np.zeros((n, units), dtype = np.float32)
+        for t in range(self.config['maximum_target_length']):
+            score = np.tanh(encoder_keys + (hidden @ w['W2_kernel'] + w['W2_bias'])[:, np.newaxis])
+            attention_weights = softmax(score @ w['V_kernel'] + w['V_bias'], axis = 1)
+            context_vector = (attention_weights * encoder_output).sum(axis = 1)
+            x = np.concatenate([context_vector, w['decoder_embedding'][ids]], axis = -1)
+            # the decoder GRU is called on a single step without an initial state, as in training, so it always starts from zeros
+            hidden = gru_step(x @ w['decoder_gru_kernel'] + self.decoder_biases[0], zeros, w['decoder_gru_recurrent_kernel'], self.decoder_biases[1])
+            ids = np.where(finished, 0, np.argmax(hidden @ w['fc_kernel'] + w['fc_bias'], axis = -1)).astype(np.int32)
+            history[:, t] = ids
+            finished |= ids == end_id
+            if finished.all():
+                break
+        # each translation ends before its <end> token
+        ends = history == end_id
+        lengths = np.where(ends.any(axis = 1), ends.argmax(axis = 1), history.shape[1])
+        self.instrument.batch_end(n, lengths.sum(), t + 1)
+        return self.target_vocabulary.decode_batch(history, lengths)
+
+    def translate(self, sentences):
+        self.instrument.batch_start()
+        sentences = [normalize_sentence(sentence.strip(), add_tokens = True) for sentence in sentences]
+        # the encoder has no mask, so the batch is padded only to its longest sentence rounded up to the length step, up to the maximum length, as each batch is in training
+        longest = max(len(sentence.split()) for sentence in sentences)
+        sources = self.source_vocabulary.encode_batch(sentences, bucket_length(longest, self.config.get('length_step', 1), self.config['maximum_source_length']))
+        self.instrument.data_ready()
+        return self.predict_encoded(sources)
+
+architectures = {'sequential': SequentialTranslator, 'attention': AttentionTranslator}
+
+def load_translator(path):
+    config, weights, vocabularies = load_bundle(path)
+    return architectures[config['architecture']](config, weights, vocabularies)
+
+# exporting the vanilla encoder decoder, a keras Sequential model of Embedding, LSTM, RepeatVector, LSTM and TimeDistributed Dense layers
+def export_sequential_translator(model, source_vocabulary, target_vocabulary, maximum_source_length, path, quantization = None):
+    embedding, encoder, repeat, decoder, dense = model.layers
+    encoder_config, decoder_config = encoder.get_config(), decoder.get_config()
+    config = {
+        'architecture': 'sequential',
+        'maximum_source_length': int(maximum_source_length),
+        'target_timesteps': int(repeat.get_config()['n']),
+        'mask_zero': bool(embedding.get_config()['mask_zero']),
+        'encoder_activation': encoder_config['activation'],
+        'encoder_recurrent_activation': encoder_config['recurrent_activation'],
+        'decoder_activation': decoder_config['activation'],
+        'decoder_recurrent_activation': decoder_config['recurrent_activation'],
+    }
+    weights = dict(zip(['embedding', 'encoder_kernel', 'encoder_recurrent_kernel', 'encoder_bias', 'decoder_kernel', 'decoder_recurrent_kernel', 'decoder_bias', 'dense_kernel', 'dense_bias'],
+                       embedding.get_weights() + encoder.get_weights() + decoder.get_weights() + dense.get_weights()))
+    save_bundle(path, config, weights, {'source': source_vocabulary, 'target': target_vocabulary}, quantization)
+
+# exporting the attention model from its Encoder and Decoder, whose GRUs may be CuDNNGRU or GRU with reset_after
+def export_attention_translator(encoder, decoder, source_vocabulary, target_vocabulary, maximum_source_length, maximum_target_length, path, quantization = None, length_step = 1):
+    config = {
+        'architecture': 'attention',
+        'maximum_source_length': int(maximum_source_length),
+        'maximum_target_length': int(maximum_target_length),
+        'length_step': int(length_step),
+    }
+    weights = {'encoder_embedding': encoder.embedding.get_weights()[0], 'decoder_embedding': decoder.embedding.get_weights()[0]}
+    for name, layer in (('encoder_gru', encoder.gru), ('decoder_gru', decoder.gru)):
+        weights[name + '_kernel'], weights[name + '_recurrent_kernel'], weights[name + '_bias'] = layer.get_weights()
+    for name, layer in (('fc', decoder.fc), ('W1', decoder.W1), ('W2', decoder.W2), ('V', decoder.V)):
+        weights[name + '_kernel'], weights[name + '_bias'] = layer.get_weights()
+    save_bundle(path, config, weights, {'source': source_vocabulary, 'target': target_vocabulary}, quantization)
+
+# the quantizations export_checked falls back to, each keeping more of the precision of the weights than the one before
+fallbacks = {'int8': 'float16', 'float16': None}
+
+# exporting a trained translator with export(path, quantization), quantized only as far as the bundle still agrees with the trained model
+# the bundle translates the held out sentences, and a quantization is kept when at least minimum_agreement of its translations equal expected, those of the trained model
+def export_checked(export, path, sentences, expected, quantization = 'float16', minimum_agreement = 0.95):
+    while True:
+        export(path, quantization)
+        agreement = np.mean([translation == reference for translation, reference in zip(load_translator(path).translate(sentences), expected)])
+        if quantization is None or agreement >= minimum_agreement:
+            return quantization, agreement
+        quantization = fallbacks[quantization]
+
+# standing in for a trained keras layer, with random weights, when benchmarking without tensorflow
+class RandomLayer():
+    def __init__(self, shapes, **config):
+        self.weights = [np.random.normal(0, 0.1, shape).astype(np.float32) for shape in shapes]
+        self.config = config
+
+    def get_weights(self):
+        return self.weights
+
+    def get_config(self):
+        return self.config
+
+class RandomModel():
+    def __init__(self, **layers):
+        self.__dict__.update(layers)
+
+# creating translators of the sizes the training scripts use, with random weights and vocabularies
+def random_translators(directory, source_size = 8000, target_size = 5000, sentence_length = 12, quantizations = (None, 'float16', 'int8')):
+    words = ['w{}'.format(i) for i in range(max(source_size, target_size))]
+    source_vocabulary = Vocabulary(np.array(['<pad>', '<unk>'] + sorted(words[:source_size - 2]), dtype = str))
+    target_vocabulary = Vocabulary(np.array(['<pad>', '<unk>'] + sorted(['<end>', '<start>'] + words[:target_size - 4]), dtype = str))
+
+    units = 256
+    sequential = RandomModel(layers = [
+        RandomLayer([(source_size, units)], mask_zero = True),
+        RandomLayer([(units, 4 * units), (units, 4 * units), (4 * units, )], activation = 'tanh', recurrent_activation = 'hard_sigmoid'),
+        RandomLayer([], n = sentence_length),
+        RandomLayer([(units, 4 * units), (units, 4 * units), (4 * units, )], activation = 'tanh', recurrent_activation = 'hard_sigmoid'),
+        RandomLayer([(units, target_size), (target_size, )])])
+
+    embedding_dimension, units = 256, 1024
+    encoder = RandomModel(embedding = RandomLayer([(source_size, embedding_dimension)]), gru = RandomLayer([(embedding_dimension, 3 * units), (units, 3 * units), (6 * units, )]))
+    decoder = RandomModel(embedding = RandomLayer([(target_size, embedding_dimension)]), gru = RandomLayer([(embedding_dimension + units, 3 * units), (units, 3 * units), (6 * units, )]),
+                          fc = RandomLayer([(units, target_size), (target_size, )]), W1 = RandomLayer([(units, units), (units, )]), W2 = RandomLayer([(units, units), (units, )]), V = RandomLayer([(units, 1), (1, )]))
+
+    paths = {}
+    for quantization in quantizations:
+        paths['sequential', quantization] = os.path.join(directory, 'sequential_{}.npz'.format(quantization))
+        export_sequential_translator(sequential, source_vocabulary, target_vocabulary, sentence_length, paths['sequential', quantization], quantization)
+        paths['attention', quantization] = os.path.join(directory, 'attention_{}.npz'.format(quantization))
+        export_attention_translator(encoder, decoder, source_vocabulary, target_vocabulary, sentence_length, sentence_length, paths['attention', quantization], quantization)
+    return paths, sequential, words[:source_size - 2]
+
+# timing translations of single sentences and of a batch
+def latencies(translator, sentences, repeats = 3):
+    tic = time.perf_counter()
+    for sentence in sentences[:repeats * 5]:
+        translator.translate([sentence])
+    single = (time.perf_counter() - tic) / (repeats * 5)
+    tic = time.perf_counter()
+    translator.translate(sentences)
+    batch = (time.perf_counter() - tic) / len(sentences)
+    return single, batch
+
+# comparing the bundles of every quantization with each other, and with the keras .h5 path when keras is installed
+def benchmark(n_sentences = 64):
+    np.random.seed(0)
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        paths, sequential, words = random_translators(directory)
+        sentences = [' '.join(np.random.choice(words, np.random.randint(3, 10))) for _ in range(n_sentences)]
+        for architecture in ('sequential', 'attention'):
+            reference = load_translator(paths[architecture, None])
+            expected = reference.translate(sentences)
+            for quantization in (None, 'float16', 'int8'):
+                path = paths[architecture, quantization]
+                startup, memory = cold_start('from inference_bundle import load_translator\nload_translator({!r}).translate([{!r}])'.format(path, sentences[0]), here)
+                translator = load_translator(path)
+                single, batch = latencies(translator, sentences)
+                error = max(np.abs(translator.weights[name] - weights).max() / max(np.abs(weights).max(), 1e-12) for name, weights in reference.weights.items())
+                agreement = np.mean([translation == reference_translation for translation, reference_translation in zip(translator.translate(sentences), expected)])
+                print('%-10s %-7s \t Size: %6.1f MB \t Cold start: %.2f s \t Peak memory: %6.1f MB \t Latency: %6.1f ms/sentence single, %5.1f ms/sentence batched \t Weight error: %.2f%% \t Same as float32 on random weights: %.0f%%'
+                      % (architecture, quantization, os.path.getsize(path) / 2 ** 20, startup, memory, 1000 * single, 1000 * batch, 100 * error, 100 * agreement))
+
+        try:
+            import keras
+        except ImportError:
+            print('keras is not installed, skipping the .h5 comparison')
+            return
+        from keras.layers import Dense, Embedding, LSTM, RepeatVector, TimeDistributed
+        from keras.models import Sequential
+        model = Sequential()
+        model.add(Embedding(8000, 256, mask_zero = True))
+        model.add(LSTM(256))
+        model.add(RepeatVector(12))
+        model.add(LSTM(256, return_sequences = True))
+        model.add(TimeDistributed(Dense(5000, activation = 'softmax')))
+        model.set_weights([weight for layer in sequential.layers for weight in layer.get_weights()])
+        h5_path = os.path.join(directory, 'sequential.h5')
+        model.save(h5_path)
+        startup, memory = cold_start('import numpy as np\nfrom keras.models import load_model\nload_model({!r}).predict(np.ones((1, 12), dtype = np.int32))'.format(h5_path), here)
+        sources = np.random.randint(1, 8000, (n_sentences, 12))
+        tic = time.perf_counter()
+        for source in sources[:15]:
+            model.predict(source[np.newaxis])
+        single = (time.perf_counter() - tic) / 15
+        tic = time.perf_counter()
+        model.predict(sources, batch_size = n_sentences)
+        batch = (time.perf_counter() - tic) / n_sentences
+        print('%-10s %-7s \t Size: %6.1f MB \t Cold start: %.2f s \t Peak memory: %6.1f MB \t Latency: %6.1f ms/sentence single, %5.1f ms/sentence batched'
+              % ('sequential', '.h5', os.path.getsize(h5_path) / 2 ** 20, startup, memory, 1000 * single, 1000 * batch))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Hooks reporting where the time of the training and decoding loops goes
+
+An instrument records, for every batch of a loop, its wall time split into the
+time spent waiting for the data and the time spent computing, the items and
+tokens it processed, the decoder steps it ran and the peak resident memory of
+the process. Records can be appended to a JSON lines file and totals served in
+the Prometheus text format on a local port.
+
+A disabled instrument is a NullInstrument: it hands iterables back unwrapped,
+gives no keras callbacks and its hooks are empty methods, so a loop costs the
+same with it as without it.
+
+Running this file directly times a loop of empty batches with and without an
+instrument, and prints what an enabled one serves.
+"""
+
+import json, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# reading the peak resident memory of the process in bytes, which linux reports in kilobytes and macOS in bytes
+def peak_memory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# accepting every hook and doing nothing, for loops run without instrumentation
+class NullInstrument():
+    enabled = False
+
+    def wrap(self, iterable):
+        return iterable
+
+    def batch_start(self):
+        pass
+
+    def data_ready(self):
+        pass
+
+    def batch_end(self, items = 0, tokens = 0, decoder_steps = 0):
+        pass
+
+    def keras_callbacks(self, tokens_per_item = 0, decoder_steps = 0):
+        return []
+
+    def render(self):
+        return ''
+
+    def close(self):
+        pass
+
+class Instrument():
+    enabled = True
+
+    def __init__(self, name, metrics_file = None, port = None, flush_every = 100):
+        self.name = name
+        self.totals = dict.fromkeys(['batches', 'items', 'tokens', 'decoder_steps', 'batch_seconds', 'data_wait_seconds', 'compute_seconds'], 0)
+        self.last = {}
+        self.lock = threading.Lock()
+        self.requested = self.received = time.perf_counter()
+        self.file = None if metrics_file is None else open(metrics_file, mode = 'at', encoding = 'utf-8')
+        self.flush_every = flush_every
+        self.server = None if port is None else serve(self, port)
+
+    # timing how long each next batch of an iterable takes to arrive, the data wait of the batch
+    def wrap(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            self.requested = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.received = time.perf_counter()
+            yield item
+
+    # starting a batch, for loops that do not iterate over their batches, its data wait lasting until data_ready
+    def batch_start(self):
+        self.requested = self.received = time.perf_counter()
+
+    def data_ready(self):
+        self.received = time.perf_counter()
+
+    def batch_end(self, items = 0, tokens = 0, decoder_steps = 0):
+        now = time.perf_counter()
+        record = {
+            'batch_seconds': now - self.requested,
+            'data_wait_seconds': self.received - self.requested,
+            'compute_seconds': now - self.received,
+            'items': int(items),
+            'tokens': int(tokens),
+            'decoder_steps': int(decoder_steps),
+        }
+        record['tokens_per_second'] = record['tokens'] / record['batch_seconds'] if record['batch_seconds'] > 0 else 0.0
+        record['peak_memory_bytes'] = peak_memory()
+        with self.lock:
+            self.totals['batches'] += 1
+            for key in ('items', 'tokens', 'decoder_steps', 'batch_seconds', 'data_wait_seconds', 'compute_seconds'):
+                self.totals[key] += record[key]
+            self.last = record
+        # a batch started neither by wrap nor by batch_start is timed from the end of the previous one
+        self.requested = self.received = now
+        if self.file is not None:
+            self.file.write(json.dumps(dict(record, name = self.name, batch = self.totals['batches'], time = time.time())) + '\n')
+            if self.totals['batches'] % self.flush_every == 0:
+                self.file.flush()
+
+    # reporting the batches of keras fit calls, the data wait being the time between the end of a batch and the start of the next one
+    # keras only tells the callbacks the size of a batch, so its tokens are counted as tokens_per_item for each of its items
+    def keras_callbacks(self, tokens_per_item = 0, decoder_steps = 0):
+        from keras.callbacks import Callback
+        instrument = self
+
+        class InstrumentCallback(Callback):
+            def on_epoch_begin(self, epoch, logs = None):
+                instrument.requested = time.perf_counter()
+
+            def on_batch_begin(self, batch, logs = None):
+                instrument.received = time.perf_counter()
+
+            def on_batch_end(self, batch, logs = None):
+                size = (logs or {}).get('size', 0)
+                instrument.batch_end(items = size, tokens = size * tokens_per_item, decoder_steps = decoder_steps)
+
+        return [InstrumentCallback()]
+
+    # writing the totals in the Prometheus text format, as counters, and the last batch, as gauges
+    def render(self):
+        with self.lock:
+            totals, last = dict(self.totals), dict(self.last)
+        lines = []
+        for key, value in totals.items():
+            metric = '{}_{}_total'.format(self.name, key)
+            lines += ['# TYPE {} counter'.format(metric), '{} {}'.format(metric, value)]
+        for key in ('tokens_per_second', 'peak_memory_bytes'):
+            if last.get(key) is not None:
+                metric = '{}_{}'.format(self.name, key)
+                lines += ['# TYPE {} gauge'.format(metric), '{} {}'.format(metric, last[key])]
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+# serving the metrics of an instrument on localhost, at /metrics, from a daemon thread
+def serve(instrument, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = instrument.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *arguments):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def create_instrument(name, enabled = True, metrics_file = None, port = None):
+    return Instrument(name, metrics_file, port) if enabled else NullInstrument()
+
+# timing a loop of batches that only sleep, without an instrument, with a disabled one and with an enabled one
+def benchmark(n_batches = 200000):
+    def loop(instrument):
+        tic = time.perf_counter()
+        for batch in instrument.wrap(range(n_batches)):
+            instrument.batch_end(items = 64, tokens = 640, decoder_steps = 10)
+        return (time.perf_counter() - tic) / n_batches
+
+    tic = time.perf_counter()
+    for batch in range(n_batches):
+        pass
+    bare = (time.perf_counter() - tic) / n_batches
+    disabled = loop(create_instrument('benchmark', enabled = False))
+    instrument = create_instrument('benchmark')
+    enabled = loop(instrument)
+    print('Overhead per batch \t Bare loop: %.2f us \t Disabled: %.2f us \t Enabled: %.2f us' % (1e6 * bare, 1e6 * disabled, 1e6 * enabled))
+    print(instrument.render())
+
+if __name__ == '__main__':
+    benchmark()
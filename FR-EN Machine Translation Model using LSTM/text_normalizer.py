@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Sentence normalizer shared by the FR - EN machine translation models
+
+Running this file directly compares its throughput in lines per second with the
+functions the two models used to define themselves, on a corpus passed as the
+first argument or on a synthetic sample otherwise.
+"""
+
+import re, sys, time, unicodedata
+
+# matching the tokens kept after cleaning: runs of letters, and each of "!", "'", ",", "-", ".", 0-9, "?" on its own
+token_pattern = re.compile(r"[a-zA-Z]+|[!',\-.0-9?]")
+
+# mapping a code point to itself without its non spacing marks, computing each code point only the first time it is seen
+class AccentTable(dict):
+    def __missing__(self, code_point):
+        stripped = ''.join(character for character in unicodedata.normalize('NFD', chr(code_point)) if unicodedata.category(character) != 'Mn')
+        self[code_point] = stripped
+        return stripped
+
+accent_table = AccentTable()
+
+# removing the accents
+def unicode_to_ascii(string):
+    if string.isascii():
+        return string
+    return string.translate(accent_table)
+
+# cleaning a sentence, and optionally adding a start and an end token to it
+def normalize_sentence(line, add_tokens = False):
+    # spacing out the punctuation, collapsing spaces and replacing everything else with space happen in one pass
+    line = ' '.join(token_pattern.findall(unicode_to_ascii(line.lower())))
+    if add_tokens:
+        line = '<start> ' + line + ' <end>'
+    return line
+
+# removing the accents, as the models did before this module
+def original_unicode_to_ascii(string):
+    return ''.join(character for character in unicodedata.normalize('NFD', string) if unicodedata.category(character) != 'Mn')
+
+# cleaning a sentence, as the models did before this module
+def original_preprocess_sentence(line):
+    line = original_unicode_to_ascii(line.lower().strip())
+    line = re.sub(r'[" "]+', " ", re.sub(r"([!',-.0-9?])", r" \1 ", line))
+    line = re.sub(r"[^a-zA-Z!',-.0-9?]+", " ", line).strip()
+    return line
+
+# measuring lines per second of a cleaning function over the given lines
+def lines_per_second(function, lines, repeats = 3):
+    best = float('inf')
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        for line in lines:
+            function(line)
+        best = min(best, time.perf_counter() - tic)
+    return len(lines) / best
+
+# comparing the original and the shared normalizer on the same lines
+def benchmark(lines):
+    mismatches = sum(normalize_sentence(line) != original_preprocess_sentence(line) for line in lines)
+    original = lines_per_second(original_preprocess_sentence, lines)
+    shared = lines_per_second(normalize_sentence, lines)
+    print('Lines: %d \t Mismatches: %d' % (len(lines), mismatches))
+    print('Original: %.0f lines/sec \t Shared: %.0f lines/sec \t Speedup: %.2fx' % (original, shared, shared / original))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], mode = 'rt', encoding = 'UTF-8') as file:
+            sample = [sentence for line in file for sentence in line.strip().split('\t')[:2]][:200000]
+    else:
+        sample = ["Va !", "Je cherche de l'eau.", "Il était 10 heures, « déjà » ?", "Où est   le café-théâtre ?", 'He said "Hi!" twice.'] * 20000
+    benchmark(sample)
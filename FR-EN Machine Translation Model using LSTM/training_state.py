@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Atomic files for resuming the training of the FR - EN machine translation models
+
+Every file is written next to its destination and renamed over it once
+complete, so a crash while saving leaves the previous file in place instead of
+a truncated one. The tokenized dataset is cached this way, with a key telling
+whether it was built from the same data, down to the content of its file, and so is the state of an interrupted
+training loop: its position in the epoch, the batch order of the epoch, its
+early stopping counters and the state of the numpy random generator.
+
+Running this file directly compares tokenizing a synthetic corpus with loading
+it from the cache, and times saving and loading a training state.
+"""
+
+import hashlib, numpy as np, os, random, string, tempfile, time
+
+# writing arrays into a .npz file that appears at path only once fully written to disk
+def atomic_savez(path, **arrays):
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary, 'wb') as file:
+            np.savez(file, **arrays)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+# reading every array of a .npz file, or None when there is no such file
+def load_arrays(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle = False) as file:
+        return {key: file[key] for key in file.files}
+
+# loading cached arrays when they were saved under the same key, and otherwise creating and caching them
+def cached_arrays(path, key, create):
+    arrays = load_arrays(path)
+    if arrays is not None and str(arrays.pop('key')) == key:
+        return arrays, True
+    arrays = create()
+    atomic_savez(path, key = np.array(key), **arrays)
+    return arrays, False
+
+# keying a cache on the arguments that built it and the name and sha256 of the file it was built from, read in blocks of block_size bytes
+# the hash tells apart files of the same name and size, such as a corpus edited in place or another release of it
+def file_key(path, *arguments, block_size = 2 ** 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return repr((os.path.basename(path), digest.hexdigest()) + arguments)
+
+# capturing the state of the numpy random generator as arrays, so that the epochs after a resume shuffle as they would have
+def random_state():
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return {'random_keys': keys, 'random_position': np.array(position), 'random_gauss': np.array([has_gauss, cached_gaussian])}
+
+def set_random_state(arrays):
+    np.random.set_state(('MT19937', arrays['random_keys'], int(arrays['random_position']), int(arrays['random_gauss'][0]), float(arrays['random_gauss'][1])))
+
+# comparing tokenizing a corpus with loading it from the cache, and saving a training state with loading it back
+def benchmark(n_sentences = 100000, n_words = 10):
+    from vocabulary import Vocabulary
+    random.seed(0)
+    words = [''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(2, 8))) for _ in range(10000)]
+    sentences = [' '.join(random.choice(words) for _ in range(random.randint(1, n_words))) for _ in range(n_sentences)]
+
+    def tokenize():
+        vocabulary = Vocabulary.fit(sentences)
+        return {'words': vocabulary.words, 'tensor': vocabulary.encode_batch(sentences)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        # both timings include hashing the corpus file for the key of the cache
+        corpus = os.path.join(directory, 'corpus.txt')
+        with open(corpus, mode = 'wt', encoding = 'utf-8') as file:
+            file.write('\n'.join(sentences))
+        path = os.path.join(directory, 'tokenized.npz')
+        tic = time.perf_counter()
+        created, hit = cached_arrays(path, file_key(corpus, n_sentences), tokenize)
+        creation = time.perf_counter() - tic
+        tic = time.perf_counter()
+        loaded, hit = cached_arrays(path, file_key(corpus, n_sentences), tokenize)
+        loading = time.perf_counter() - tic
+        identical = hit and all(np.array_equal(created[key], loaded[key]) for key in created)
+        print('Sentences: %d \t Tokenizing: %.3f s \t Cache: %.3f s \t Speedup: %.1fx \t Identical: %s' % (n_sentences, creation, loading, creation / loading, identical))
+
+        path = os.path.join(directory, 'state.npz')
+        order = np.random.permutation(35000 - 35000 % 64).reshape(-1, 64)
+        tic = time.perf_counter()
+        atomic_savez(path, epoch = np.array(3), batch = np.array(250), order = order, **random_state())
+        saving = time.perf_counter() - tic
+        expected = np.random.random(5)
+        tic = time.perf_counter()
+        state = load_arrays(path)
+        set_random_state(state)
+        loading = time.perf_counter() - tic
+        identical = np.array_equal(state['order'], order) and np.array_equal(np.random.random(5), expected)
+        print('Training state \t Save: %.4f s \t Load: %.4f s \t Identical: %s' % (saving, loading, identical))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Array backed vocabulary shared by the FR - EN machine translation models
+
+Running this file directly compares encoding and decoding a synthetic corpus
+with the dictionaries the models used before this module, and times loading a
+saved vocabulary with and without memory mapping.
+"""
+
+import numpy as np, os, random, string, tempfile, time
+from collections import Counter
+from itertools import repeat
+
+# mapping words to ids and back with a single array of words: 0 is padding, 1 is unknown and the kept words follow in sorted order
+# the array is all that is saved, so a serving process memory maps it and only builds the word -> id dictionary from its few thousand words
+class Vocabulary():
+    padding, unknown = '<pad>', '<unk>'
+    padding_id, unknown_id = 0, 1
+
+    def __init__(self, words):
+        self.words = words
+        self.word_to_id = {word: index for index, word in enumerate(words.tolist())}
+        del self.word_to_id[self.unknown]
+
+    # counting words over the sentences, keeping the max_size - 2 most frequent of those seen at least min_count times
+    @classmethod
+    def fit(cls, sentences, max_size = None, min_count = 1):
+        counts = Counter(word for sentence in sentences for word in sentence.split())
+        kept = sorted((word for word, count in counts.items() if count >= min_count), key = lambda word: (-counts[word], word))
+        if max_size is not None:
+            kept = kept[:max(max_size - 2, 0)]
+        return cls(np.array([cls.padding, cls.unknown] + sorted(kept), dtype = str))
+
+    @classmethod
+    def load(cls, path, mmap_mode = 'r'):
+        return cls(np.load(path, mmap_mode = mmap_mode))
+
+    def save(self, path):
+        np.save(path, np.asarray(self.words))
+
+    def __len__(self):
+        return len(self.words)
+
+    # finding the id of every word of a list at once, straight into an int32 array, unknown words included
+    def lookup(self, words):
+        return np.fromiter(map(self.word_to_id.get, words, repeat(self.unknown_id)), dtype = np.int32, count = len(words))
+
+    def index(self, word):
+        return self.word_to_id.get(word, self.unknown_id)
+
+    # encoding sentences into a post padded int32 matrix, truncating them after maximum_length words, which defaults to the longest sentence
+    # the matrix is allocated once, or passed in as out, and all ids are written into it with a single scatter
+    def encode_batch(self, sentences, maximum_length = None, out = None):
+        tokens = [sentence.split() for sentence in sentences]
+        lengths = np.array([len(sentence_tokens) for sentence_tokens in tokens], dtype = np.int64)
+        if maximum_length is None:
+            maximum_length = int(lengths.max()) if len(lengths) else 0
+        lengths = np.minimum(lengths, maximum_length)
+        if out is None:
+            out = np.zeros((len(tokens), maximum_length), dtype = np.int32)
+        else:
+            out[:] = self.padding_id
+        flat = [word for sentence_tokens, length in zip(tokens, lengths) for word in sentence_tokens[:length]]
+        out[np.arange(out.shape[1]) < lengths[:, np.newaxis]] = self.lookup(flat)
+        return out
+
+    # decoding a matrix of ids into sentences, each ending at its length or otherwise at its first padding id
+    def decode_batch(self, ids, lengths = None):
+        ids = np.asarray(ids)
+        if lengths is None:
+            padded = ids == self.padding_id
+            lengths = np.where(padded.any(axis = 1), padded.argmax(axis = 1), ids.shape[1])
+        # looking every id up at once and converting the words to python strings in one pass before joining them
+        words = self.words[ids].tolist()
+        return [' '.join(row[:length]) for row, length in zip(words, np.asarray(lengths).tolist())]
+
+# encoding sentences with a dictionary lookup per word and a python list per sentence, as the models did before this module
+def original_encode(word_to_index, sentences, maximum_length):
+    sequences = [[word_to_index[word] for word in sentence.split(' ')] for sentence in sentences]
+    tensor = np.zeros((len(sequences), maximum_length), dtype = np.int32)
+    for row, sequence in zip(tensor, sequences):
+        row[:len(sequence)] = sequence[:maximum_length]
+    return tensor
+
+# decoding one id at a time through a dictionary, as the models did before this module
+def original_decode(index_to_word, tensor):
+    return [' '.join(index_to_word[index] for index in row if index != 0) for row in tensor]
+
+# comparing the original dictionaries and the array backed vocabulary on the same sentences
+def benchmark(n_sentences = 100000, n_words = 10):
+    random.seed(0)
+    words = [''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(2, 8))) for _ in range(10000)]
+    sentences = [' '.join(random.choice(words) for _ in range(random.randint(1, n_words))) for _ in range(n_sentences)]
+
+    vocabulary = Vocabulary.fit(sentences)
+    word_to_index = {word: index for index, word in enumerate(vocabulary.words)}
+    index_to_word = {index: word for word, index in word_to_index.items()}
+
+    tic = time.perf_counter()
+    expected = original_encode(word_to_index, sentences, n_words)
+    original_encoding = time.perf_counter() - tic
+    tic = time.perf_counter()
+    encoded = vocabulary.encode_batch(sentences, n_words)
+    encoding = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    expected_sentences = original_decode(index_to_word, expected)
+    original_decoding = time.perf_counter() - tic
+    tic = time.perf_counter()
+    decoded = vocabulary.decode_batch(encoded)
+    decoding = time.perf_counter() - tic
+
+    identical = np.array_equal(expected, encoded) and expected_sentences == decoded == sentences
+    print('Sentences: %d \t Vocabulary: %d \t Identical: %s' % (n_sentences, len(vocabulary), identical))
+    print('Encoding \t Original: %.3f s \t Vocabulary: %.3f s \t Speedup: %.1fx' % (original_encoding, encoding, original_encoding / encoding))
+    print('Decoding \t Original: %.3f s \t Vocabulary: %.3f s \t Speedup: %.1fx' % (original_decoding, decoding, original_decoding / decoding))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'vocabulary.npy')
+        vocabulary.save(path)
+        tic = time.perf_counter()
+        Vocabulary.fit(sentences)
+        refit = time.perf_counter() - tic
+        tic = time.perf_counter()
+        loaded = Vocabulary.load(path, mmap_mode = None)
+        load = time.perf_counter() - tic
+        tic = time.perf_counter()
+        mapped = Vocabulary.load(path)
+        mapping = time.perf_counter() - tic
+        identical = np.array_equal(mapped.encode_batch(sentences, n_words), encoded) and np.array_equal(loaded.words, vocabulary.words)
+        del mapped
+    print('Startup \t Refit: %.3f s \t Load: %.4f s \t Memory map: %.4f s \t Identical: %s' % (refit, load, mapping, identical))
+
+if __name__ == '__main__':
+    benchmark()
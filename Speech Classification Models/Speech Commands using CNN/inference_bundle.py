@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Self contained inference bundles for the speech classification CNNs
+
+A bundle is a single .npz file with the layers of a trained keras Sequential
+CNN, their weights optionally quantized to int8 or float16, and the labels of
+its classes. Loading a bundle needs only numpy, the layers running in numpy on
+the CPU, so a classifier starts without importing keras or the notebooks. The
+loaded classifier offers predict and output_shape like the keras model, so it
+can stand in for it, for example in the keyword spotter.
+
+Running this file directly exports the Speech Commands CNN with random weights
+in every quantization and compares their size, cold start, peak memory and
+latency per clip, with the keras .h5 path alongside when keras is installed.
+"""
+
+import json, numpy as np, os, sys, tempfile, time
+# quantize, dequantize and cold_start are shared with the translation bundles, in bundle_tools.py at the root of the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from bundle_tools import cold_start, dequantize, quantize
+
+def softmax(x):
+    x = np.exp(x - x.max(axis = -1, keepdims = True))
+    return(x / x.sum(axis = -1, keepdims = True))
+
+activations = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'softmax': softmax,
+}
+
+# Defining the layers of the CNN in numpy, each taking a batch of channels last inputs
+def conv2d(x, kernel, bias, config):
+    if config['padding'] != 'valid' or tuple(config['strides']) != (1, 1):
+        raise ValueError('Only valid convolutions with unit strides are supported')
+    rows, columns = kernel.shape[:2]
+    height, width = x.shape[1] - rows + 1, x.shape[2] - columns + 1
+    # summing one matrix product per kernel position over shifted views of the input
+    output = bias + sum(x[:, i:(i + height), j:(j + width)] @ kernel[i, j] for i in range(rows) for j in range(columns))
+    return(activations[config['activation']](output))
+
+def max_pooling2d(x, config):
+    rows, columns = config['pool_size']
+    if config['padding'] != 'valid' or tuple(config['strides']) != (rows, columns):
+        raise ValueError('Only valid poolings with strides equal to their size are supported')
+    height, width = x.shape[1] // rows, x.shape[2] // columns
+    x = x[:, :(height * rows), :(width * columns)]
+    return(x.reshape(len(x), height, rows, width, columns, x.shape[3]).max(axis = (2, 4)))
+
+def dense(x, kernel, bias, config):
+    return(activations[config['activation']](x @ kernel + bias))
+
+layers = {
+    'Conv2D': conv2d,
+    'MaxPooling2D': max_pooling2d,
+    'Flatten': lambda x, config: x.reshape(len(x), -1),
+    'Dense': dense,
+    # dropout is only active during training
+    'Dropout': lambda x, config: x,
+}
+
+# Defining a classifier running the layers of a bundle in order, with the predict and output_shape of a keras model
+class Classifier():
+    def __init__(self, path):
+        with np.load(path, allow_pickle = False) as bundle:
+            self.config = json.loads(str(bundle['config']))
+            self.labels = bundle['labels'].tolist()
+            self.weights = []
+            for index in range(len(self.config['layers'])):
+                weights = []
+                while 'weights/{}/{}'.format(index, len(weights)) in bundle.files:
+                    key = '{}/{}'.format(index, len(weights))
+                    weights.append(dequantize(bundle['weights/' + key], bundle['scales/' + key] if 'scales/' + key in bundle.files else None))
+                self.weights.append(weights)
+        self.output_shape = (None, len(self.labels))
+
+    def predict(self, x, batch_size = 32):
+        x = np.asarray(x, dtype = np.float32)
+        outputs = []
+        for start in range(0, len(x), batch_size):
+            batch = x[start:(start + batch_size)]
+            for (name, config), weights in zip(self.config['layers'], self.weights):
+                batch = layers[name](batch, *weights, config)
+            outputs.append(batch)
+        return(np.concatenate(outputs) if outputs else np.zeros((0, len(self.labels)), dtype = np.float32))
+
+    def classify(self, x):
+        return([self.labels[index] for index in np.argmax(self.predict(x), axis = -1)])
+
+# Defining a function to export a trained keras Sequential CNN with the labels of its classes, only keeping the settings the numpy layers use
+def export_classifier(model, labels, path, quantization = None):
+    settings = ('activation', 'padding', 'strides', 'pool_size')
+    config = {'layers': [], 'quantization': quantization}
+    arrays = {'labels': np.array(labels, dtype = str)}
+    for index, layer in enumerate(model.layers):
+        name = type(layer).__name__
+        if name not in layers:
+            raise ValueError('Layers of type {} are not supported'.format(name))
+        config['layers'].append((name, {key: value for key, value in layer.get_config().items() if key in settings}))
+        # the convolutions and the dense layers have their kernel first and their bias second, and the bias is kept in float32
+        for number, weights in enumerate(layer.get_weights()):
+            arrays['weights/{}/{}'.format(index, number)], scale = quantize(weights, quantization, bias = number == 1)
+            if scale is not None:
+                arrays['scales/{}/{}'.format(index, number)] = scale
+    arrays['config'] = np.array(json.dumps(config))
+    with open(path, 'wb') as file:
+        np.savez(file, **arrays)
+
+# Defining a stand in for a trained keras layer, with random weights, to benchmark without keras
+class RandomLayer():
+    def __init__(self, shapes, **config):
+        self.weights = [np.random.normal(0, 0.1, shape).astype(np.float32) for shape in shapes]
+        self.config = config
+
+    def get_weights(self):
+        return(self.weights)
+
+    def get_config(self):
+        return(self.config)
+
+# Defining a function to create a stand in layer whose type has the name of the keras layer it replaces
+def random_layer(name, shapes, **config):
+    return(type(name, (RandomLayer, ), {})(shapes, **config))
+
+class RandomModel():
+    def __init__(self, layers):
+        self.layers = layers
+
+# Defining the CNN of the Speech Commands notebook with random weights
+def random_model(feature_dim_1 = 20, feature_dim_2 = 11, num_classes = 30):
+    flattened = ((feature_dim_1 - 3) // 2) * ((feature_dim_2 - 3) // 2) * 128
+    return(RandomModel([
+        random_layer('Conv2D', [(2, 2, 1, 32), (32, )], activation = 'relu', padding = 'valid', strides = (1, 1)),
+        random_layer('Conv2D', [(2, 2, 32, 64), (64, )], activation = 'relu', padding = 'valid', strides = (1, 1)),
+        random_layer('Conv2D', [(2, 2, 64, 128), (128, )], activation = 'relu', padding = 'valid', strides = (1, 1)),
+        random_layer('MaxPooling2D', [], pool_size = (2, 2), padding = 'valid', strides = (2, 2)),
+        random_layer('Flatten', []),
+        random_layer('Dense', [(flattened, 256), (256, )], activation = 'relu'),
+        random_layer('Dropout', []),
+        random_layer('Dense', [(256, 512), (512, )], activation = 'relu'),
+        random_layer('Dropout', []),
+        random_layer('Dense', [(512, num_classes), (num_classes, )], activation = 'softmax')]))
+
+# Defining a function to time single clips and a batch of clips
+def latencies(model, clips, repeats = 20):
+    tic = time.perf_counter()
+    for clip in clips[:repeats]:
+        model.predict(clip[np.newaxis])
+    single = (time.perf_counter() - tic) / repeats
+    tic = time.perf_counter()
+    model.predict(clips, batch_size = len(clips))
+    return(single, (time.perf_counter() - tic) / len(clips))
+
+# Defining a function to compare the bundles of every quantization with each other, and with the keras .h5 path when keras is installed
+def benchmark(n_clips = 256):
+    np.random.seed(0)
+    here = os.path.dirname(os.path.abspath(__file__))
+    model = random_model()
+    labels = ['label_{}'.format(i) for i in range(30)]
+    clips = np.random.normal(0, 50, (n_clips, 20, 11, 1)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as directory:
+        expected = None
+        for quantization in (None, 'float16', 'int8'):
+            path = os.path.join(directory, 'model_{}.npz'.format(quantization))
+            export_classifier(model, labels, path, quantization)
+            startup, memory = cold_start('import numpy as np\nfrom inference_bundle import Classifier\nClassifier({!r}).predict(np.zeros((1, 20, 11, 1)))'.format(path), here)
+            classifier = Classifier(path)
+            single, batch = latencies(classifier, clips)
+            predictions = np.argmax(classifier.predict(clips), axis = -1)
+            expected = predictions if expected is None else expected
+            print('%-7s \t Size: %5.2f MB \t Cold start: %.2f s \t Peak memory: %5.1f MB \t Latency: %.3f ms/clip single, %.3f ms/clip batched \t Same as float32: %.1f%%'
+                  % (quantization, os.path.getsize(path) / 2 ** 20, startup, memory, 1000 * single, 1000 * batch, 100 * np.mean(predictions == expected)))
+
+        try:
+            import keras
+        except ImportError:
+            print('keras is not installed, skipping the .h5 comparison')
+            return
+        from keras.layers import Conv2D, Dense, Dropout, Flatten, MaxPooling2D
+        from keras.models import Sequential
+        keras_model = Sequential()
+        keras_model.add(Conv2D(32, kernel_size = (2, 2), activation = 'relu', input_shape = (20, 11, 1)))
+        keras_model.add(Conv2D(64, kernel_size = (2, 2), activation = 'relu'))
+        keras_model.add(Conv2D(128, kernel_size = (2, 2), activation = 'relu'))
+        keras_model.add(MaxPooling2D(pool_size = (2, 2)))
+        keras_model.add(Flatten())
+        keras_model.add(Dense(256, activation = 'relu'))
+        keras_model.add(Dropout(0.125))
+        keras_model.add(Dense(512, activation = 'relu'))
+        keras_model.add(Dropout(0.25))
+        keras_model.add(Dense(30, activation = 'softmax'))
+        keras_model.set_weights([weights for layer in model.layers for weights in layer.get_weights()])
+        path = os.path.join(directory, 'model.h5')
+        keras_model.save(path)
+        startup, memory = cold_start('import numpy as np\nfrom keras.models import load_model\nload_model({!r}).predict(np.zeros((1, 20, 11, 1)))'.format(path), here)
+        single, batch = latencies(keras_model, clips)
+        print('%-7s \t Size: %5.2f MB \t Cold start: %.2f s \t Peak memory: %5.1f MB \t Latency: %.3f ms/clip single, %.3f ms/clip batched \t Same as bundle: %.1f%%'
+              % ('.h5', os.path.getsize(path) / 2 ** 20, startup, memory, 1000 * single, 1000 * batch, 100 * np.mean(np.argmax(keras_model.predict(clips), axis = -1) == expected)))
+
+if __name__ == '__main__':
+    benchmark()
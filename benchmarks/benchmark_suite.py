@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite timing the main stages of the models on the CPU
+
+Every stage runs on a synthetic corpus, so the suite needs neither the
+datasets nor a GPU. Functions of the Colab scripts and of the notebooks are
+loaded from their source without running them: the definitions a stage needs
+are picked out of the file, or out of the code cells of the notebook, and
+executed along with whichever of its imports are installed. Stages needing a
+package that is not installed, such as keras, tensorflow or librosa, are
+reported as skipped.
+
+The results are written as JSON, with the throughput of every stage, the
+peak memory traced by tracemalloc in the benchmark process, and on linux the
+peak resident memory of the benchmark process and of every process it starts,
+such as the workers of the create_dataset pool. When a baseline is given, the
+suite exits with status 1 if a stage runs slower, or peaks higher in memory,
+than the baseline by more than the threshold, or if a stage measured in the
+baseline is skipped. Timings on a shared machine vary by up to half between
+runs, hence the loose default threshold, which a quiet machine can tighten.
+
+The baseline is only as complete as the machine that recorded it: stages
+skipped there are not checked. The training, decoding, keras and wav2mfcc
+stages need tensorflow, keras and librosa, so the baseline should be recorded
+with --save-baseline where they are installed, and --strict then also fails
+on any stage skipped in the baseline or in the run.
+
+Usage:
+    python benchmarks/benchmark_suite.py
+    python benchmarks/benchmark_suite.py --stages wer,levenshtein --threshold 0.5
+    python benchmarks/benchmark_suite.py --save-baseline
+    python benchmarks/benchmark_suite.py --strict
+"""
+
+import argparse, ast, json, numpy as np, os, platform, random, string, sys, tempfile, threading, time, tracemalloc, types, wave
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+translation = os.path.join(root, 'FR-EN Machine Translation Model using LSTM')
+vanilla_script = os.path.join(translation, 'LSTM with Vanilla Encoder Decoder', 'fr_en_vanilla_encoder_decoder_machine_translation_model_with_lstm.py')
+attention_script = os.path.join(translation, 'GRU with Attention', 'fr_en_encoder_decoder_machine_translation_model_with_gru_and_attention.py')
+speech_notebook = os.path.join(root, 'Speech Classification Models', 'Speech Commands using CNN', 'Speech Classification Model for Speech Commands.ipynb')
+comparison = os.path.join(root, 'Comparison of Speech Recognition and Neural Machine Translation APIs')
+sys.path[:0] = [translation, comparison]
+
+# raised by a stage whose requirements are not installed
+class Skip(Exception):
+    pass
+
+# reading the code of a script, or of the code cells of a notebook without their magics
+def source_cells(path):
+    with open(path, mode = 'rt', encoding = 'utf-8') as file:
+        if not path.endswith('.ipynb'):
+            return [file.read()]
+        cells = [''.join(cell['source']) for cell in json.load(file)['cells'] if cell['cell_type'] == 'code']
+    return ['\n'.join(line for line in cell.splitlines() if not line.lstrip().startswith(('%', '!'))) for cell in cells]
+
+# executing the imports and the named top level definitions of a script or notebook in a new module, leaving the rest of its code unrun
+# the module is registered in sys.modules, so that its functions can be pickled for forked process pools
+def load_definitions(path, names):
+    module = types.ModuleType('benchmarked_' + ''.join(character if character.isalnum() else '_' for character in os.path.basename(path)))
+    sys.modules[module.__name__] = module
+    trees = [ast.parse(source) for source in source_cells(path)]
+    for node in (node for tree in trees for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))):
+        try:
+            exec(compile(ast.Module([node], []), path, 'exec'), module.__dict__)
+        except ImportError:
+            pass
+    found = set()
+    for node in (node for tree in trees for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef))):
+        if node.name in names:
+            exec(compile(ast.Module([node], []), path, 'exec'), module.__dict__)
+            found.add(node.name)
+    if set(names) - found:
+        raise LookupError('{} not found in {}'.format(', '.join(sorted(set(names) - found)), path))
+    return module
+
+def require(*packages):
+    for package in packages:
+        try:
+            __import__(package)
+        except ImportError:
+            raise Skip('{} is not installed'.format(package))
+
+# creating french and english like sentence pairs from random words, with accents and punctuation for the normalizer
+def synthetic_pairs(n_pairs, seed = 0):
+    generator = random.Random(seed)
+    words = [''.join(generator.choice(string.ascii_lowercase + 'éèàç') for _ in range(generator.randint(1, 8))) for _ in range(3000)]
+    sentence = lambda: ' '.join(generator.choice(words) for _ in range(generator.randint(2, 10))).capitalize() + generator.choice(['.', ' ?', ' !', ', oui.'])
+    return [(sentence(), sentence()) for _ in range(n_pairs)]
+
+stages = {}
+
+# registering a stage, a function of the corpus scale returning the callable to time and the number of items it processes
+def stage(name, unit):
+    def register(function):
+        stages[name] = (function, unit)
+        return function
+    return register
+
+@stage('normalize_sentence', 'lines')
+def normalize_stage(scale, directory):
+    from text_normalizer import normalize_sentence
+    lines = [line for pair in synthetic_pairs(int(20000 * scale)) for line in pair]
+    return (lambda: [normalize_sentence(line, add_tokens = True) for line in lines]), len(lines)
+
+@stage('create_dataset', 'lines')
+def create_dataset_stage(scale, directory):
+    script = load_definitions(vanilla_script, ['create_dataset'])
+    pairs = synthetic_pairs(int(20000 * scale))
+    path = os.path.join(directory, 'pairs.txt')
+    with open(path, mode = 'wt', encoding = 'UTF-8') as file:
+        file.writelines('{}\t{}\n'.format(*pair) for pair in pairs)
+    return (lambda: script.create_dataset(path, len(pairs))), len(pairs)
+
+@stage('load_dataset', 'sentences')
+def load_dataset_stage(scale, directory):
+    from text_normalizer import normalize_sentence
+    script = load_definitions(vanilla_script, ['maximum_length', 'encode_sequences', 'encode_output'])
+    pairs = np.array([[normalize_sentence(line) for line in pair] for pair in synthetic_pairs(int(20000 * scale))])
+
+    # fitting both vocabularies and encoding both sides, as load_dataset does after splitting the corpus
+    def run():
+        for side in (0, 1):
+            vocabulary = script.Vocabulary.fit(pairs[:, side])
+            encoded = script.encode_sequences(vocabulary, script.maximum_length(pairs[:, side]), pairs[:, side])
+        return script.encode_output(encoded)
+    return run, len(pairs)
+
+@stage('tokenized_cache', 'sentences')
+def tokenized_cache_stage(scale, directory):
+    from text_normalizer import normalize_sentence
+    from training_state import cached_arrays, file_key
+    from vocabulary import Vocabulary
+    lines = synthetic_pairs(int(20000 * scale))
+    pairs = np.array([[normalize_sentence(line, add_tokens = True) for line in pair] for pair in lines])
+    corpus = os.path.join(directory, 'fra.txt')
+    with open(corpus, mode = 'wt', encoding = 'utf-8') as file:
+        file.write('\n'.join('\t'.join(pair) for pair in lines))
+
+    # caching the tensors and vocabularies of both sides once, then timing the loads a restart of the attention model does instead of load_dataset, hashing the corpus file for the key included
+    def create():
+        arrays = {'pairs': pairs}
+        for side, name in ((0, 'target'), (1, 'source')):
+            vocabulary = Vocabulary.fit(pairs[:, side])
+            arrays[name + '_words'], arrays[name + '_tensor'] = vocabulary.words, vocabulary.encode_batch(pairs[:, side])
+        return arrays
+    path = os.path.join(directory, 'tokenized_dataset.npz')
+    cached_arrays(path, file_key(corpus, len(pairs)), create)
+    return (lambda: cached_arrays(path, file_key(corpus, len(pairs)), create)), len(pairs)
+
+@stage('vanilla_train_step', 'batches')
+def vanilla_train_step_stage(scale, directory):
+    require('keras')
+    script = load_definitions(vanilla_script, ['define_model'])
+    model = script.define_model(8000, 5000, 12, 256)
+    model.compile(optimizer = 'adam', loss = 'sparse_categorical_crossentropy')
+    sources, targets = np.random.randint(1, 8000, (64, 12)), np.random.randint(1, 5000, (64, 12, 1))
+    model.train_on_batch(sources, targets)
+    n_batches = max(1, int(5 * scale))
+    return (lambda: [model.train_on_batch(sources, targets) for _ in range(n_batches)]), n_batches
+
+@stage('attention_train_step', 'batches')
+def attention_train_step_stage(scale, directory):
+    require('tensorflow')
+    script = load_definitions(attention_script, ['gru', 'Encoder', 'Decoder', 'loss_function', 'train_step'])
+    tf = script.tf
+    if not tf.executing_eagerly():
+        tf.enable_eager_execution()
+    batch_size = 64
+    script.encoder = script.Encoder(8000, 256, 1024, batch_size)
+    script.decoder = script.Decoder(5000, 256, 1024, batch_size)
+    script.start_tokens = tf.fill([batch_size, 1], 2)
+    X, Y = tf.constant(np.random.randint(1, 8000, (batch_size, 12))), tf.constant(np.random.randint(1, 5000, (batch_size, 12)))
+    hidden = script.encoder.initialize_hidden_state()
+    script.train_step(X, Y, hidden)
+    n_batches = max(1, int(2 * scale))
+    return (lambda: [script.train_step(X, Y, hidden) for _ in range(n_batches)]), n_batches
+
+# decoding with the decode_batch of the attention script, on the encoder and decoder it trains, rather than with the numpy bundle
+def decode_batch_stage(beam_width, batched, scale, directory):
+    require('tensorflow')
+    from instrumentation import NullInstrument
+    from vocabulary import Vocabulary
+    script = load_definitions(attention_script, ['preprocess_sentence', 'gru', 'Encoder', 'Decoder', 'tile_beams', 'decode_batch'])
+    tf = script.tf
+    if not tf.executing_eagerly():
+        tf.enable_eager_execution()
+    script.units, script.decoding_instrument, script.LENGTH_STEP = 1024, NullInstrument(), 4
+    pairs = synthetic_pairs(max(1, int(64 * scale)))
+    target_vocabulary, source_vocabulary = (Vocabulary.fit([script.preprocess_sentence(pair[side]) for pair in synthetic_pairs(2000)]) for side in (0, 1))
+    encoder, decoder = script.Encoder(len(source_vocabulary), 256, 1024, 64), script.Decoder(len(target_vocabulary), 256, 1024, 64)
+    sentences = [source for target, source in pairs]
+    if batched:
+        return (lambda: script.decode_batch(sentences, encoder, decoder, source_vocabulary, target_vocabulary, 16, 16, beam_width)), len(sentences)
+    sentences = sentences[:max(1, len(sentences) // 4)]
+    return (lambda: [script.decode_batch([sentence], encoder, decoder, source_vocabulary, target_vocabulary, 16, 16, beam_width) for sentence in sentences]), len(sentences)
+
+stage('attention_decode_single', 'sentences')(lambda scale, directory: decode_batch_stage(1, False, scale, directory))
+stage('attention_decode_batch', 'sentences')(lambda scale, directory: decode_batch_stage(1, True, scale, directory))
+stage('attention_beam_search', 'sentences')(lambda scale, directory: decode_batch_stage(3, True, scale, directory))
+
+# exporting translators with random weights once, shared by the stages timing the numpy bundles that serve the trained models
+translators = {}
+
+def random_translator(architecture, directory):
+    from inference_bundle import load_translator, random_translators
+    if not translators:
+        paths, _, words = random_translators(directory, quantizations = (None, ))
+        translators.update({name: load_translator(paths[name, None]) for name in ('sequential', 'attention')}, words = words)
+    generator = random.Random(0)
+    return translators[architecture], [' '.join(generator.choice(translators['words']) for _ in range(generator.randint(3, 10))) for _ in range(64)]
+
+def translate_stage(architecture, batched, scale, directory):
+    translator, sentences = random_translator(architecture, directory)
+    sentences = sentences[:max(1, int(len(sentences) * scale))]
+    if batched:
+        return (lambda: translator.translate(sentences)), len(sentences)
+    sentences = sentences[:max(1, len(sentences) // 4)]
+    return (lambda: [translator.translate([sentence]) for sentence in sentences]), len(sentences)
+
+stage('vanilla_translate_single', 'sentences')(lambda scale, directory: translate_stage('sequential', False, scale, directory))
+stage('vanilla_translate_batch', 'sentences')(lambda scale, directory: translate_stage('sequential', True, scale, directory))
+stage('attention_translate_single', 'sentences')(lambda scale, directory: translate_stage('attention', False, scale, directory))
+stage('attention_translate_batch', 'sentences')(lambda scale, directory: translate_stage('attention', True, scale, directory))
+
+@stage('vanilla_predict_sequences', 'sentences')
+def vanilla_predict_stage(scale, directory):
+    require('keras')
+    script = load_definitions(vanilla_script, ['define_model', 'predict_sequences'])
+    from vocabulary import Vocabulary
+    model = script.define_model(8000, 5000, 12, 256)
+    target_vocabulary = Vocabulary(np.array(['<pad>', '<unk>'] + ['w{}'.format(i) for i in range(4998)]))
+    sources = np.random.randint(1, 8000, (max(1, int(256 * scale)), 12))
+    return (lambda: script.predict_sequences(model, target_vocabulary, sources)), len(sources)
+
+@stage('wav2mfcc', 'clips')
+def wav2mfcc_stage(scale, directory):
+    require('librosa')
+    notebook = load_definitions(speech_notebook, ['wav2mfcc'])
+    paths = []
+    for index in range(max(1, int(50 * scale))):
+        paths.append(os.path.join(directory, 'clip_{}.wav'.format(index)))
+        with wave.open(paths[-1], 'wb') as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(16000)
+            file.writeframes((np.random.normal(0, 3000, 16000)).astype(np.int16).tobytes())
+    return (lambda: [notebook.wav2mfcc(path) for path in paths]), len(paths)
+
+def edit_distance_pairs(scale):
+    from edit_distance import sentence_pair
+    random.seed(0)
+    words = [''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(1, 6))) for _ in range(200)]
+    return list(zip(*[sentence_pair(random.randint(5, 30), words) for _ in range(max(1, int(2000 * scale)))]))
+
+@stage('wer', 'pairs')
+def wer_stage(scale, directory):
+    from edit_distance import wer_batch
+    hypotheses, references = edit_distance_pairs(scale)
+    return (lambda: wer_batch(hypotheses, references)), len(hypotheses)
+
+@stage('levenshtein', 'pairs')
+def levenshtein_stage(scale, directory):
+    from edit_distance import levenshtein_batch
+    hypotheses, references = edit_distance_pairs(scale)
+    return (lambda: levenshtein_batch(hypotheses, references)), len(hypotheses)
+
+@stage('corpus_bleu', 'sentences')
+def corpus_bleu_stage(scale, directory):
+    from corpus_metrics import corpus_bleu
+    hypotheses, references = edit_distance_pairs(scale)
+    return (lambda: corpus_bleu(hypotheses, references)), len(hypotheses)
+
+# summing the resident memory of a process and of all its descendants, read from /proc, as tracemalloc only sees the allocations of this process
+def tree_rss(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as file:
+                    children.setdefault(int(file.read().rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+            except OSError:
+                pass
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open('/proc/{}/statm'.format(current)) as file:
+                total += int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass
+    return total
+
+# sampling the resident memory of the process tree while run runs, returning its peak above the memory resident before the run, or None without /proc
+def peak_rss(run, interval = 0.01):
+    if not os.path.isdir('/proc/self'):
+        run()
+        return None
+    start = peak = tree_rss(os.getpid())
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(interval):
+            peak = max(peak, tree_rss(os.getpid()))
+
+    sampler = threading.Thread(target = sample, daemon = True)
+    sampler.start()
+    try:
+        run()
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak, tree_rss(os.getpid())) - start
+
+# timing the best of a few runs, then tracing the peak memory of one more run, as tracing slows the code down, and sampling the resident memory of a last one
+def measure(run, n_items, repeats):
+    run()
+    best = float('inf')
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - tic)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss = peak_rss(run)
+    return {'items': n_items, 'seconds': best, 'throughput': n_items / best, 'peak_memory_mb': peak / 2 ** 20, 'peak_rss_mb': None if rss is None else rss / 2 ** 20}
+
+def run_stages(names, scale, repeats):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            function, unit = stages[name]
+            try:
+                run, n_items = function(scale, directory)
+                results[name] = dict(status = 'ok', unit = unit, **measure(run, n_items, repeats))
+                rss = results[name]['peak_rss_mb']
+                print('%-28s %12.1f %s/s \t peak %8.2f MB \t resident peak %s' % (name, results[name]['throughput'], unit, results[name]['peak_memory_mb'], 'unknown' if rss is None else '%8.2f MB' % rss))
+            # a module importing a package that is not installed skips its stages like require does
+            except (Skip, ImportError) as reason:
+                results[name] = {'status': 'skipped', 'reason': str(reason)}
+                print('%-28s skipped: %s' % (name, reason))
+    return results
+
+# comparing every stage measured both times, a regression being a throughput below, or a peak memory above, the baseline by more than threshold
+# a stage measured in the baseline but skipped now is a regression too, and with strict so is a stage skipped in either of them
+# peaks under memory_floor megabytes are not compared, as their relative changes are mostly noise
+def compare(results, baseline, threshold, memory_floor = 1.0, strict = False):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name, {})
+        if result['status'] != 'ok' and (reference.get('status') == 'ok' or strict):
+            regressions.append('{}: skipped ({})'.format(name, result['reason']))
+            continue
+        if reference.get('status') != 'ok':
+            if strict:
+                regressions.append('{}: not measured in the baseline'.format(name))
+            continue
+        if result['throughput'] < (1 - threshold) * reference['throughput']:
+            regressions.append('{}: {:.1f} {}/s against {:.1f} in the baseline'.format(name, result['throughput'], result['unit'], reference['throughput']))
+        for key, label in (('peak_memory_mb', 'traced peak'), ('peak_rss_mb', 'resident peak')):
+            if result.get(key) is None or reference.get(key) is None:
+                continue
+            if max(result[key], reference[key]) > memory_floor and result[key] > (1 + threshold) * reference[key]:
+                regressions.append('{}: {} {:.2f} MB against {:.2f} MB in the baseline'.format(name, label, result[key], reference[key]))
+    return regressions
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'system': platform.system(), 'cpus': os.cpu_count()}
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = 'Time the main stages of the models on the CPU and check them against a baseline.')
+    parser.add_argument('--stages', default = ','.join(stages), help = 'comma separated stages to run, all of them by default')
+    parser.add_argument('--scale', type = float, default = 1.0, help = 'multiplier of the synthetic corpus sizes')
+    parser.add_argument('--repeats', type = int, default = 5, help = 'timed runs per stage, the best one being kept')
+    parser.add_argument('--output', default = 'benchmark_results.json', help = 'where to write the results')
+    parser.add_argument('--baseline', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'), help = 'results to compare against')
+    parser.add_argument('--threshold', type = float, default = 0.5, help = 'relative slowdown or memory growth counted as a regression, loose by default for shared machines')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'write the results as the new baseline instead of comparing')
+    parser.add_argument('--strict', action = 'store_true', help = 'also count a stage skipped in the run or in the baseline as a regression')
+    arguments = parser.parse_args(arguments)
+
+    names = [name.strip() for name in arguments.stages.split(',') if name.strip()]
+    unknown = [name for name in names if name not in stages]
+    if unknown:
+        parser.error('unknown stages: {}'.format(', '.join(unknown)))
+
+    report = {'environment': environment(), 'scale': arguments.scale, 'stages': run_stages(names, arguments.scale, arguments.repeats)}
+    with open(arguments.baseline if arguments.save_baseline else arguments.output, mode = 'wt', encoding = 'utf-8') as file:
+        json.dump(report, file, indent = 2)
+    if arguments.save_baseline or not os.path.exists(arguments.baseline):
+        return 0
+
+    with open(arguments.baseline, mode = 'rt', encoding = 'utf-8') as file:
+        baseline = json.load(file)
+    if baseline.get('scale') != arguments.scale:
+        print('The baseline was measured at scale {}, not comparing'.format(baseline.get('scale')))
+        return 0
+    if baseline.get('environment') != report['environment']:
+        print('The baseline was measured on {}, timings may not be comparable'.format(baseline.get('environment')))
+    regressions = compare(report['stages'], baseline['stages'], arguments.threshold, strict = arguments.strict)
+    for regression in regressions:
+        print('Regression in ' + regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the inference bundles of the translation and speech models
+
+Both bundles store their weights the same way, quantized to int8 with a
+float32 scale per output column or to float16, and both benchmarks measure the
+cold start of a fresh interpreter the same way, so these live here once and
+each inference_bundle.py imports them.
+"""
+
+import numpy as np, subprocess, sys
+
+# storing weights as int8 with a float32 scale per output column, or as float16, biases always staying float32
+# biases are told apart by their role, which the caller knows, as some have two dimensions, such as the bias of a GRU with reset_after
+def quantize(weights, quantization = None, bias = False):
+    weights = np.asarray(weights, dtype = np.float32)
+    if quantization is None or bias:
+        return weights, None
+    if quantization == 'float16':
+        return weights.astype(np.float16), None
+    if quantization == 'int8':
+        scale = np.abs(weights).max(axis = tuple(range(weights.ndim - 1))) / 127
+        scale[scale == 0] = 1
+        return np.round(weights / scale).astype(np.int8), scale.astype(np.float32)
+    raise ValueError('Unknown quantization: {}'.format(quantization))
+
+def dequantize(values, scale = None):
+    values = values.astype(np.float32)
+    if scale is not None:
+        values *= scale
+    return values
+
+# measuring in a fresh interpreter started in directory the seconds from start to the end of code and the peak resident memory, in megabytes
+# the peak is read from /proc, as on linux ru_maxrss keeps the peak of the benchmark process that started the interpreter
+def cold_start(code, directory):
+    script = 'import time\ntic = time.perf_counter()\n' + code + '\nprint(time.perf_counter() - tic, [line.split()[1] for line in open("/proc/self/status") if line.startswith("VmHWM")][0])'
+    output = subprocess.run([sys.executable, '-c', script], cwd = directory, stdout = subprocess.PIPE, check = True).stdout.split()
+    return float(output[-2]), float(output[-1]) / 1024